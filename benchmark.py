@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Startup benchmark for pygeocoder.
+
+Runs fresh interpreters to time ``import pygeocoder`` and a single lookup
+answered from the result cache, each measured against a bare interpreter, and
+exits with status 1 when either goes over its budget.
+
+Usage:
+    python benchmark.py [--runs 20] [--import-budget 20] [--lookup-budget 40]
+
+"""
+
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+BARE = 'pass'
+
+IMPORT = 'import pygeocoder'
+
+CACHED_LOOKUP = '''
+from pygeocoder import Geocoder
+from pygeocache import ResultCache
+results = [{
+    "formatted_address": "1600 Amphitheatre Parkway, Mountain View, CA 94043, USA",
+    "geometry": {"location": {"lat": 37.4224764, "lng": -122.0842499}},
+    "types": ["street_address"],
+}]
+geocoder = Geocoder(result_cache=ResultCache(soft_ttl=60))
+geocoder.fetch_data = lambda params: results
+geocoder.geocode("1600 amphitheatre mountain view ca")
+del geocoder.fetch_data
+assert geocoder.geocode("1600 amphitheatre mountain view ca").coordinates
+assert geocoder.result_cache.hits == 1
+'''
+
+
+def timed(code, here):
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code], cwd=here)
+    return (time.time() - start) * 1000
+
+
+def run(code, runs):
+    """
+    Return the median extra wall time, in milliseconds, of running `code`
+    in a fresh interpreter over a bare one. Each run is paired with a bare
+    run started right before it, so load changes on the machine cancel out.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(runs):
+        bare = timed(BARE, here)
+        timings.append(timed(code, here) - bare)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main():
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--runs", dest="runs", type="int", default=20,
+                      help="Interpreters to start per measurement")
+    parser.add_option("--import-budget", dest="import_budget", type="float", default=20.0,
+                      help="Allowed milliseconds for importing pygeocoder")
+    parser.add_option("--lookup-budget", dest="lookup_budget", type="float", default=40.0,
+                      help="Allowed milliseconds for importing and one cached lookup")
+    (options, args) = parser.parse_args()
+
+    failed = False
+    print('%-16s %10s %10s' % ('benchmark', 'ms', 'budget'))
+    for name, code, budget in (('import', IMPORT, options.import_budget),
+                               ('cached lookup', CACHED_LOOKUP, options.lookup_budget)):
+        elapsed = run(code, options.runs)
+        over = elapsed > budget
+        failed = failed or over
+        print('%-16s %10.1f %10.1f%s' % (name, elapsed, budget, '  OVER BUDGET' if over else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Concurrent batch geocoding with an adaptive in-flight limit.
+
+:class:`AdaptiveLimit` tunes how many requests may be in flight from what
+the server reports back:
+
+* ``OVER_QUERY_LIMIT``, server errors and timeouts cut the limit by
+  `backoff`, at most once per round trip so a burst of errors from one
+  window counts once.
+* When the smoothed latency rises past `tolerance` times the lowest of the
+  last `window` samples, the limit shrinks by the latency gradient
+  (lowest / smoothed).
+* While latency is stable and at least half the limit is in use, every
+  success adds ``1 / limit``, about one slot per window of requests.
+
+Only network fetches take a slot and feed back latency: results served by
+the result cache would otherwise pull the lowest latency down to
+microseconds and keep the limit shrinking.
+
+Example:
+
+    limit = AdaptiveLimit(initial=4, max_limit=32)
+    results = geocoder.batch_geocode(addresses, concurrency=limit)
+    print(limit.metrics())
+
+"""
+
+import threading
+import time
+from collections import deque
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from pygeolib import GeocoderError
+
+__all__ = ['AdaptiveLimit', 'as_limit', 'map_batch', 'run_batch']
+
+#: Feedback signal for failures other than ``OVER_QUERY_LIMIT``
+ERROR = 'error'
+
+# statuses which mean the server answered normally
+_ANSWERED = (GeocoderError.G_GEO_ZERO_RESULTS, GeocoderError.G_GEO_MISSING_QUERY,
+             GeocoderError.G_GEO_REQUEST_DENIED)
+
+
+class AdaptiveLimit(object):
+    """
+    In-flight request limit driven by latency and error feedback.
+
+    Requests run through :meth:`call`, or callers :meth:`acquire` a slot
+    before each request and :meth:`release` it with the observed latency and
+    outcome.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, backoff=0.5,
+                 tolerance=2.0, smoothing=0.2, clock=time.time, history=100,
+                 window=100, retry_delay=0.5, sleep=time.sleep):
+        """
+        :param initial: Starting limit
+        :param min_limit: Lowest the limit goes
+        :param max_limit: Highest the limit goes
+        :param backoff: Factor applied to the limit on errors
+        :param tolerance: Ratio of smoothed to lowest latency treated as stable
+        :param smoothing: Weight of each new sample in the smoothed latency
+        :param clock: Function returning the current time in seconds
+        :param history: Number of limit changes kept for :meth:`metrics`
+        :param window: Number of latency samples the lowest latency is taken
+            over, so it follows the server when it gets slower for good
+        :param retry_delay: Seconds :func:`run_batch` waits before retrying a
+            request after ``OVER_QUERY_LIMIT``, doubled for each retry
+        :param sleep: Function used to wait
+        """
+        if not 1 <= min_limit <= initial <= max_limit:
+            raise ValueError("limits must satisfy 1 <= min_limit <= initial <= max_limit")
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.clock = clock
+        self.retry_delay = retry_delay
+        self.sleep = sleep
+        self.in_flight = 0
+        self.min_latency = None
+        self.latency = None
+        self.increases = 0
+        self.decreases = 0
+        self.reasons = {}
+        self.reason = 'initial'
+        self.history = deque(maxlen=history)
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = None
+        self._cond = threading.Condition()
+
+    @classmethod
+    def fixed(cls, limit):
+        """
+        Return a limit which never changes.
+        """
+        return cls(initial=limit, min_limit=limit, max_limit=limit)
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call `func` in a slot and feed its latency and outcome back.
+        """
+        self.acquire()
+        start = self.clock()
+        try:
+            result = func(*args, **kwargs)
+        except GeocoderError as err:
+            self.release(self.clock() - start, err.status)
+            raise
+        except Exception:
+            self.release(self.clock() - start, ERROR)
+            raise
+        self.release(self.clock() - start)
+        return result
+
+    def release(self, latency=None, status=None):
+        """
+        Free a slot and adjust the limit.
+
+        :param latency: Seconds the request took
+        :type latency: float
+        :param status: ``None`` on success, else the ``GeocoderError`` status
+            or :data:`ERROR`
+        """
+        with self._cond:
+            # only probe upward when at least half the limit is being used
+            in_use = self.in_flight * 2 >= self.limit
+            self.in_flight -= 1
+            if status == GeocoderError.G_GEO_OVER_QUERY_LIMIT:
+                self._decrease(self.limit * self.backoff, 'over_query_limit')
+            elif status is not None and status not in _ANSWERED:
+                self._decrease(self.limit * self.backoff, 'error')
+            elif latency is not None:
+                self._observe(latency, in_use)
+            self._cond.notify_all()
+
+    def metrics(self):
+        """
+        Return the current limit, the reason for its last change and the
+        statistics behind it.
+
+        :rtype: dict
+        """
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'reason': self.reason,
+                'latency': self.latency,
+                'min_latency': self.min_latency,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'reasons': dict(self.reasons),
+                'history': list(self.history),
+            }
+
+    def _observe(self, latency, in_use):
+        self._latencies.append(latency)
+        self.min_latency = min(self._latencies)
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        if self.latency > self.min_latency * self.tolerance:
+            gradient = self.min_latency / self.latency
+            self._decrease(self.limit * max(gradient, self.backoff), 'latency')
+        elif in_use:
+            self._change(self.limit + 1.0 / self.limit, 'probe')
+
+    def _decrease(self, limit, reason):
+        now = self.clock()
+        if (self._last_decrease is not None and self.latency is not None and
+                now - self._last_decrease < self.latency):
+            return
+        self._last_decrease = now
+        self._change(limit, reason)
+
+    def _change(self, limit, reason):
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(limit) != int(self.limit):
+            if limit > self.limit:
+                self.increases += 1
+            else:
+                self.decreases += 1
+            self.reason = reason
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+            self.history.append((self.clock(), int(limit), reason))
+        self.limit = limit
+
+
+def as_limit(concurrency):
+    """
+    Return `concurrency` as an :class:`AdaptiveLimit`: ``None`` stays
+    ``None`` and an int becomes a fixed limit.
+    """
+    if concurrency is None or isinstance(concurrency, AdaptiveLimit):
+        return concurrency
+    return AdaptiveLimit.fixed(concurrency)
+
+
+def map_batch(func, items, limit=None, throttle=True):
+    """
+    Call `func` on every item, one after the other when `limit` is ``None``
+    and with :func:`run_batch` otherwise.
+
+    :returns: For each item, the value returned by `func` or the exception it
+        raised, in the order of `items`
+    :rtype: list
+    """
+    if limit is not None:
+        return run_batch(func, items, limit, throttle=throttle)
+    results = []
+    for item in items:
+        try:
+            results.append(func(item))
+        except Exception as err:
+            results.append(err)
+    return results
+
+
+def run_batch(func, items, limit, retries=3, max_workers=None, throttle=True):
+    """
+    Call `func` on every item from a pool of threads, keeping at most
+    `limit` calls in flight. Items failing with ``OVER_QUERY_LIMIT`` are
+    retried up to `retries` times, after waiting the limit's `retry_delay`
+    doubled for each retry.
+
+    :param func: Callable taking one item
+    :param items: Items to process
+    :param limit: Limit on calls in flight
+    :type limit: AdaptiveLimit
+    :param max_workers: Number of threads, defaults to the highest limit
+    :param throttle: ``False`` when `func` runs its own requests through
+        :meth:`AdaptiveLimit.call`, so work done without a request, such as
+        a cache hit, neither waits for a slot nor skews the latency
+    :returns: For each item, the value returned by `func` or the exception it
+        raised, in the order of `items`
+    :rtype: list
+    """
+    items = list(items)
+    results = [None] * len(items)
+    if not items:
+        return results
+    workers = min(max_workers or limit.max_limit, len(items))
+    queue = Queue()
+
+    def work():
+        while True:
+            task = queue.get()
+            if task is None:
+                queue.task_done()
+                return
+            index, attempt = task
+            try:
+                if throttle:
+                    results[index] = limit.call(func, items[index])
+                else:
+                    results[index] = func(items[index])
+            except GeocoderError as err:
+                if err.status == GeocoderError.G_GEO_OVER_QUERY_LIMIT and attempt < retries:
+                    limit.sleep(limit.retry_delay * 2 ** attempt)
+                    queue.put((index, attempt + 1))
+                else:
+                    results[index] = err
+            except Exception as err:
+                results[index] = err
+            queue.task_done()
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for index in range(len(items)):
+        queue.put((index, 0))
+    queue.join()
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return results
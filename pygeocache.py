@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Result caching for :class:`pygeocoder.Geocoder`.
+
+A :class:`ResultCache` keeps results in process memory (L1) with a soft and a
+hard TTL. Until the soft TTL an entry is fresh. Between the soft and the hard
+TTL the stale entry is served immediately and a refresh is queued on a
+background worker, at most one per key. Past the hard TTL the entry is dropped
+and the next lookup fetches synchronously.
+
+A :class:`CacheBackend` can be plugged in as a shared L2 so that a fleet of
+processes geocodes each address once. :class:`RedisBackend` speaks the Redis
+protocol; :class:`MemoryBackend` keeps everything in process and can be served
+over a local socket with :func:`serve_backend` for testing.
+
+Example:
+
+    cache = ResultCache(soft_ttl=3600, hard_ttl=86400,
+                        backend=RedisBackend('cache.internal'))
+    geocoder = Geocoder(result_cache=cache)
+
+"""
+
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__all__ = ['ResultCache', 'CacheBackend', 'CacheBackendError', 'MemoryBackend',
+           'RedisBackend', 'JSONSerializer', 'cache_key', 'serve_backend']
+
+# stored_at timestamp prepended to every L2 payload
+_FRAME = struct.Struct('<d')
+
+
+def cache_key(params):
+    """
+    Return a stable cache key for a dictionary of query parameters.
+
+    :param params: Dictionary mapping (string) query parameters to values
+    :type params: dict
+    :rtype: string
+    """
+    # JSON escapes the values, so no two queries share a key
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+
+class CacheBackendError(Exception):
+    """Raised when a shared cache backend replies with an error."""
+
+
+class JSONSerializer(object):
+    """
+    Serializes raw results as compact, zlib compressed JSON.
+    """
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def dumps(self, data):
+        return zlib.compress(
+            json.dumps(data, separators=(',', ':')).encode('utf-8'), self.level)
+
+    def loads(self, payload):
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+class ResultCache(object):
+    """
+    Thread-safe cache of raw geocoder results with stale-while-revalidate.
+
+    The cache stores the raw results list returned by
+    :meth:`Geocoder.get_data`, so every lookup builds its own
+    :class:`GeocoderResult` and iteration state is never shared.
+
+    With a `backend`, entries missing from process memory are looked up in
+    the shared L2 before calling the loader, and every fresh result is written
+    through to it. L2 failures are counted in `backend_errors` and treated as
+    misses, so an unreachable backend never fails a lookup.
+    """
+
+    key_prefix = 'pygeocoder:'
+
+    def __init__(self, soft_ttl, hard_ttl=None, maxsize=None, clock=time.time,
+                 backend=None, serializer=None):
+        """
+        :param soft_ttl: Seconds after which an entry is refreshed in the background.
+        :type soft_ttl: float
+        :param hard_ttl: Seconds after which an entry is no longer served.
+            Defaults to `soft_ttl`, which makes this a plain TTL cache.
+        :type hard_ttl: float
+        :param maxsize: Maximum number of entries; least recently used entries
+            are evicted first. ``None`` means unbounded.
+        :type maxsize: int
+        :param clock: Function returning the current time in seconds.
+        :param backend: Shared L2 cache
+        :type backend: CacheBackend
+        :param serializer: Object with ``dumps`` and ``loads`` used for L2
+            payloads. Defaults to :class:`JSONSerializer`. The
+            :mod:`pygeopack` module can be passed instead, when other
+            processes read the payloads with :class:`pygeopack.PackedResults`.
+        """
+        if hard_ttl is None:
+            hard_ttl = soft_ttl
+        if hard_ttl < soft_ttl:
+            raise ValueError("hard_ttl must not be shorter than soft_ttl")
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = hard_ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.backend = backend
+        self.serializer = serializer if serializer is not None else JSONSerializer()
+        self.hits = 0
+        self.remote_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.backend_errors = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._queue = Queue()
+        self._worker = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, loader):
+        """
+        Return the cached data for `key`, calling `loader` when it is missing
+        or past its hard TTL. Stale entries are returned as is and refreshed
+        with `loader` on the background worker.
+
+        :param key: Cache key, see :func:`cache_key`
+        :param loader: Callable without arguments fetching fresh data
+        """
+        now = self.clock()
+        entry = self._get_local(key, now)
+        if entry is None and self.backend is not None:
+            entry = self._get_remote(key, now)
+        if entry is None:
+            self._count('misses')
+            data = loader()
+            self.set(key, data)
+            return data
+        with self._lock:
+            if now - entry[0] < self.soft_ttl:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                self._schedule_refresh(key, loader)
+        return entry[1]
+
+    def prefetch(self, keys):
+        """
+        Load every key missing from process memory from the L2 backend with a
+        single multi-get, so a following batch of lookups hits locally.
+
+        :param keys: Cache keys, see :func:`cache_key`
+        :return: Number of entries loaded from the backend
+        :rtype: int
+        """
+        if self.backend is None:
+            return 0
+        now = self.clock()
+        missing = []
+        seen = set()
+        for key in keys:
+            if key not in seen:
+                seen.add(key)
+                if self._get_local(key, now) is None:
+                    missing.append(key)
+        if not missing:
+            return 0
+        try:
+            payloads = self.backend.get_many([self._backend_key(key) for key in missing])
+        except (EnvironmentError, CacheBackendError):
+            self._count('backend_errors')
+            return 0
+        loaded = 0
+        for key, payload in zip(missing, payloads):
+            if payload is None:
+                continue
+            entry = self._decode(payload)
+            if now - entry[0] < self.hard_ttl:
+                self._set_local(key, entry)
+                loaded += 1
+        return loaded
+
+    def set(self, key, data, stored_at=None):
+        """
+        Store `data` under `key`, stamped with `stored_at` or the current time,
+        and write it through to the L2 backend.
+        """
+        if stored_at is None:
+            stored_at = self.clock()
+        self._set_local(key, (stored_at, data))
+        if self.backend is not None:
+            ttl = int(math.ceil(self.hard_ttl - (self.clock() - stored_at)))
+            if ttl > 0:
+                try:
+                    self.backend.set(self._backend_key(key),
+                                     _FRAME.pack(stored_at) + self.serializer.dumps(data),
+                                     ttl=ttl)
+                except (EnvironmentError, CacheBackendError):
+                    self._count('backend_errors')
+
+    def invalidate(self, key):
+        """
+        Drop `key` from the cache if present.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.backend is not None:
+            try:
+                self.backend.delete(self._backend_key(key))
+            except (EnvironmentError, CacheBackendError):
+                self._count('backend_errors')
+
+    def clear(self):
+        """
+        Drop every entry held in process memory. The L2 backend is left alone.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def join(self):
+        """
+        Block until every queued background refresh has completed.
+        """
+        self._queue.join()
+
+    def _count(self, counter):
+        # lookups come from many threads during concurrent batches
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _backend_key(self, key):
+        import hashlib
+        return self.key_prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _decode(self, payload):
+        stored_at, = _FRAME.unpack_from(payload)
+        return stored_at, self.serializer.loads(payload[_FRAME.size:])
+
+    def _get_local(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry[0] < self.hard_ttl:
+                self._touch(key, entry)
+                return entry
+            del self._entries[key]
+            return None
+
+    def _get_remote(self, key, now):
+        try:
+            payload = self.backend.get(self._backend_key(key))
+        except (EnvironmentError, CacheBackendError):
+            self._count('backend_errors')
+            return None
+        if payload is None:
+            return None
+        entry = self._decode(payload)
+        if now - entry[0] >= self.hard_ttl:
+            return None
+        self._set_local(key, entry)
+        self._count('remote_hits')
+        return entry
+
+    def _set_local(self, key, entry):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            if self.maxsize is not None:
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+    def _touch(self, key, entry):
+        # OrderedDict.move_to_end is Python 3 only
+        del self._entries[key]
+        self._entries[key] = entry
+
+    def _schedule_refresh(self, key, loader):
+        # called with self._lock held
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        self._queue.put((key, loader))
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._refresh_loop)
+            self._worker.daemon = True
+            self._worker.start()
+
+    def _refresh(self, key, loader):
+        if self.backend is not None:
+            # another process may already have refreshed this key
+            now = self.clock()
+            entry = self._get_remote(key, now)
+            if entry is not None and now - entry[0] < self.soft_ttl:
+                return
+        self.set(key, loader())
+
+    def _refresh_loop(self):
+        while True:
+            key, loader = self._queue.get()
+            try:
+                self._refresh(key, loader)
+                self._count('refreshes')
+            except Exception:
+                # keep serving the stale entry until its hard TTL runs out
+                self._count('refresh_errors')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+                self._queue.task_done()
+
+
+class CacheBackend(object):
+    """
+    Interface of a shared L2 cache holding byte string values.
+
+    Subclasses implement :meth:`get_many`, :meth:`set_many` and :meth:`delete`.
+    Connection problems are raised as :exc:`EnvironmentError` and error replies
+    as :exc:`CacheBackendError`.
+    """
+
+    def get(self, key):
+        """
+        Return the value stored under `key`, or ``None``.
+        """
+        return self.get_many([key])[0]
+
+    def set(self, key, value, ttl=None):
+        """
+        Store `value` under `key`, expiring after `ttl` seconds if given.
+        """
+        self.set_many({key: value}, ttl=ttl)
+
+    def get_many(self, keys):
+        """
+        Return a list with the value stored under each key, or ``None``.
+        """
+        raise NotImplementedError
+
+    def set_many(self, mapping, ttl=None):
+        """
+        Store every key/value pair of `mapping`.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Process-local :class:`CacheBackend`, mostly useful for testing.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_many(self, keys):
+        now = self.clock()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and entry[1] is not None and entry[1] <= now:
+                    del self._data[key]
+                    entry = None
+                values.append(entry[0] if entry is not None else None)
+        return values
+
+    def set_many(self, mapping, ttl=None):
+        expires = self.clock() + ttl if ttl is not None else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (value, expires)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def flush(self):
+        with self._lock:
+            self._data.clear()
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, type(u'')):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+def _encode_command(args):
+    parts = [('*%d\r\n' % len(args)).encode('ascii')]
+    for arg in args:
+        arg = _to_bytes(arg)
+        parts.append(('$%d\r\n' % len(arg)).encode('ascii'))
+        parts.append(arg)
+        parts.append(b'\r\n')
+    return b''.join(parts)
+
+
+def _encode_reply(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        return b'+OK\r\n' if value else b'$-1\r\n'
+    if isinstance(value, int):
+        return (':%d\r\n' % value).encode('ascii')
+    if isinstance(value, list):
+        return (('*%d\r\n' % len(value)).encode('ascii') +
+                b''.join(_encode_reply(item) for item in value))
+    if isinstance(value, CacheBackendError):
+        return ('-ERR %s\r\n' % value).encode('utf-8')
+    value = _to_bytes(value)
+    return ('$%d\r\n' % len(value)).encode('ascii') + value + b'\r\n'
+
+
+def _read_reply(stream):
+    line = stream.readline()
+    if not line.endswith(b'\r\n'):
+        raise IOError("connection closed by cache backend")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise CacheBackendError(rest.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise IOError("connection closed by cache backend")
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [_read_reply(stream) for _ in range(length)]
+    raise CacheBackendError("unexpected reply %r" % line)
+
+
+class RedisBackend(CacheBackend):
+    """
+    :class:`CacheBackend` talking the Redis protocol (RESP) over one pipelined
+    connection. Works with Redis and anything speaking its protocol, including
+    :func:`serve_backend`.
+    """
+
+    def __init__(self, host='localhost', port=6379, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sock = None
+        self._stream = None
+        self._lock = threading.Lock()
+
+    def execute(self, *commands):
+        """
+        Send every command in one write and return their replies in order.
+        Error replies are raised as :exc:`CacheBackendError` once every reply
+        has been read.
+
+        :param commands: Sequences of command arguments, e.g. ``('GET', key)``
+        :rtype: list
+        """
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._connect()
+                self._sock.sendall(b''.join(_encode_command(command) for command in commands))
+                replies = []
+                for _ in commands:
+                    try:
+                        replies.append(_read_reply(self._stream))
+                    except CacheBackendError as err:
+                        replies.append(err)
+            except EnvironmentError:
+                self._close()
+                raise
+        for reply in replies:
+            if isinstance(reply, CacheBackendError):
+                raise reply
+        return replies
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return self.execute(['MGET'] + list(keys))[0]
+
+    def set_many(self, mapping, ttl=None):
+        if ttl is None:
+            commands = [('SET', key, value) for key, value in mapping.items()]
+        else:
+            commands = [('SET', key, value, 'EX', ttl) for key, value in mapping.items()]
+        if commands:
+            self.execute(*commands)
+
+    def delete(self, key):
+        self.execute(('DEL', key))
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _connect(self):
+        import socket
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._stream = self._sock.makefile('rb')
+
+    def _close(self):
+        if self._sock is not None:
+            self._stream.close()
+            self._sock.close()
+        self._sock = None
+        self._stream = None
+
+
+def _serve_connection(backend, rfile, wfile):
+    # answer the commands of one client until it disconnects
+    while True:
+        try:
+            command = _read_reply(rfile)
+        except (EnvironmentError, CacheBackendError):
+            return
+        if not isinstance(command, list) or not command:
+            return
+        name = command[0].upper()
+        args = [arg.decode('utf-8') for arg in command[1:2]] + command[2:]
+        try:
+            if name == b'PING':
+                reply = True
+            elif name == b'GET':
+                reply = backend.get(args[0])
+            elif name == b'MGET':
+                reply = backend.get_many([arg.decode('utf-8') for arg in command[1:]])
+            elif name == b'SET':
+                ttl = int(args[3]) if len(args) > 3 and args[2].upper() == b'EX' else None
+                backend.set(args[0], args[1], ttl=ttl)
+                reply = True
+            elif name == b'DEL':
+                backend.delete(args[0])
+                reply = 1
+            else:
+                reply = CacheBackendError("unknown command %r" % name)
+        except IndexError:
+            reply = CacheBackendError("wrong number of arguments")
+        wfile.write(_encode_reply(reply))
+
+
+def serve_backend(backend, host='127.0.0.1', port=0):
+    """
+    Serve `backend` over the Redis protocol on a background thread, so a
+    :class:`RedisBackend` can be tested without a Redis server.
+
+    :param backend: Backend to expose, usually a :class:`MemoryBackend`
+    :type backend: CacheBackend
+    :return: The running server; its ``server_address`` gives the bound
+        port and ``shutdown()`` stops it.
+    """
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            _serve_connection(self.server.backend, self.rfile, self.wfile)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+    server = Server((host, port), Handler)
+    server.backend = backend
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
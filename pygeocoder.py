@@ -16,23 +16,12 @@ Python wrapper for Google Geocoding API V3.
 
 """
 
-import requests
-import requests_cache
 import functools
-import base64
-import hmac
-import hashlib
-try:
-    from urllib.parse import urlparse
-except ImportError:
-    from urlparse import urlparse
-from pygeolib import GeocoderError, GeocoderResult
+from pygeolib import GeocoderError, GeocoderResult, project
 from __version__ import VERSION
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+# requests, requests_cache and the signing modules are imported where they are
+# first needed, which keeps `import pygeocoder` cheap for short-lived processes
 
 __all__ = ['Geocoder', 'GeocoderError', 'GeocoderResult']
 
@@ -46,6 +35,52 @@ class omnimethod(object):
         return functools.partial(self.func, instance)
 
 
+class _NoPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NO_PHASE = _NoPhase()
+
+
+def _phase(geocoder, name):
+    """
+    Time phase `name` when `geocoder` is profiling, otherwise do nothing.
+    """
+    if geocoder is not None and geocoder.profiler is not None:
+        return geocoder.profiler.phase(name)
+    return _NO_PHASE
+
+
+def _make_result(data, fields=None, first_only=False):
+    """
+    Wrap raw results in a :class:`GeocoderResult`, or project them onto
+    `fields` so nothing else is kept.
+    """
+    if first_only:
+        data = data[:1]
+    if fields is None:
+        return GeocoderResult(data)
+    records = project(data, fields)
+    return records[0] if first_only else records
+
+
+def _lookup(geocoder, name, params, fields=None, first_only=False, limit=None):
+    """
+    Get the data for `params` as phase `name` and wrap it with
+    :func:`_make_result`. `geocoder` is ``None`` for static calls.
+    """
+    with _phase(geocoder, name):
+        if geocoder is not None:
+            data = geocoder.get_data(params=params, limit=limit)
+        else:
+            data = Geocoder.get_data(params=params, limit=limit)
+        with _phase(geocoder, 'result'):
+            return _make_result(data, fields, first_only)
+
+
 class Geocoder(object):
     """
     A Python wrapper for Google Geocoding V3's API
@@ -55,7 +90,8 @@ class Geocoder(object):
     GEOCODE_QUERY_URL = 'https://maps.google.com/maps/api/geocode/json?'
     USER_AGENT = 'pygeocoder/' + VERSION + ' (Python)'
 
-    def __init__(self, api_key=None, client_id=None, private_key=None, cache_name=None):
+    def __init__(self, api_key=None, client_id=None, private_key=None, cache_name=None,
+                 result_cache=None, profile=False, transport=None):
         """
         Create a new :class:`Geocoder` object using the given `client_id` and
         `private_key`.
@@ -69,6 +105,16 @@ class Geocoder(object):
         :param private_key: Google Maps Premier API key
         :type client_id: string
 
+        :param result_cache: In-process cache of geocoder results
+        :type result_cache: pygeocache.ResultCache
+
+        :param profile: ``True`` to record per-phase timings of every call in
+            `profiler`, or a :class:`pygeoprofile.Profiler` to record into
+        :type profile: bool or pygeoprofile.Profiler
+
+        :param transport: Sends the HTTP requests, see :mod:`pygeotransport`.
+            Defaults to :class:`pygeotransport.HTTPTransport`.
+
         Google Maps API Premier users can provide his key to make 100,000
         requests a day vs the standard 2,500 requests a day without a key
 
@@ -77,7 +123,14 @@ class Geocoder(object):
         self.client_id = client_id
         self.private_key = private_key
         self.proxy = None
+        self.result_cache = result_cache
+        self.transport = transport
+        if profile is True:
+            from pygeoprofile import Profiler
+            profile = Profiler()
+        self.profiler = profile or None
         if cache_name is not None:
+            import requests_cache
             requests_cache.install_cache(cache_name)
 
     @omnimethod
@@ -88,7 +141,10 @@ class Geocoder(object):
         bounds='',
         region='',
         language='',
-        components=''):
+        components='',
+        fields=None,
+        first_only=False,
+        limit=None):
         """
         Given a string address, return a dictionary of information about
         that location, including its latitude and longitude.
@@ -105,7 +161,16 @@ class Geocoder(object):
         :type components: string
         :param language: The language in which to return results.
         :type language: string
-        :returns: `geocoder return value`_ dictionary
+        :param fields: Only keep these fields of each result, see
+            :func:`pygeolib.project`, e.g. ``('coordinates', 'postal_code')``.
+        :type fields: tuple of string
+        :param first_only: Only keep the first result.
+        :type first_only: bool
+        :param limit: Limit the request runs under when it is not answered
+            from the result cache.
+        :type limit: pygeobatch.AdaptiveLimit
+        :returns: `geocoder return value`_ dictionary. With `fields`, a list of
+            slim records instead, or a single record with `first_only`.
         :rtype: dict
         :raises GeocoderError: if there is something wrong with the query.
 
@@ -126,13 +191,11 @@ class Geocoder(object):
             'components': components,
         }
 
-        if self is not None:
-            return GeocoderResult(self.get_data(params=params))
-        else:
-            return GeocoderResult(Geocoder.get_data(params=params))
+        return _lookup(self, 'geocode', params, fields, first_only, limit)
 
     @omnimethod
-    def reverse_geocode(self, lat, lng, sensor='false', bounds='', region='', language=''):
+    def reverse_geocode(self, lat, lng, sensor='false', bounds='', region='', language='',
+                        fields=None, first_only=False):
         """
         Converts a (latitude, longitude) pair to an address.
 
@@ -162,10 +225,62 @@ class Geocoder(object):
             'language': language,
         }
 
-        if self is not None:
-            return GeocoderResult(self.get_data(params=params))
-        else:
-            return GeocoderResult(Geocoder.get_data(params=params))
+        return _lookup(self, 'reverse_geocode', params, fields, first_only)
+
+    @omnimethod
+    def batch_geocode(
+        self,
+        addresses,
+        sensor='false',
+        bounds='',
+        region='',
+        language='',
+        components='',
+        fields=None,
+        first_only=False,
+        concurrency=None):
+        """
+        Geocode every address in `addresses` with the same options.
+
+        When the result cache has a shared backend, every address is looked up
+        there with a single multi-get before the first query is sent.
+
+        :param addresses: Addresses of locations to be geocoded.
+        :type addresses: list of string
+        :param concurrency: Addresses geocoded at once. ``None`` geocodes them
+            one after the other, an int that many at a time, and a
+            :class:`pygeobatch.AdaptiveLimit` tunes the number from latency
+            and ``OVER_QUERY_LIMIT`` errors, retrying the latter.
+        :type concurrency: int or pygeobatch.AdaptiveLimit
+        :returns: For each address, its :class:`GeocoderResult` (or projection,
+            see `fields`) or the exception raised while geocoding it, such as a
+            :class:`GeocoderError` or ``requests.Timeout``.
+        :rtype: list
+
+        Keyword arguments are identical to those of :meth:`geocode()`.
+
+        """
+        queries = [{
+            'address':  address,
+            'sensor':   sensor,
+            'bounds':   bounds,
+            'region':   region,
+            'language': language,
+            'components': components,
+        } for address in addresses]
+
+        if self and self.result_cache is not None:
+            from pygeocache import cache_key
+            self.result_cache.prefetch([cache_key(params) for params in queries])
+
+        from pygeobatch import as_limit, map_batch
+        limit = as_limit(concurrency)
+
+        def lookup(params):
+            return _lookup(self, 'geocode', params, fields, first_only, limit)
+
+        # only fetches take a slot of the limit, cache hits run freely
+        return map_batch(lookup, queries, limit, throttle=False)
 
     def set_proxy(self, proxy):
         """
@@ -176,44 +291,92 @@ class Geocoder(object):
         self.proxy = proxy
 
     @omnimethod
-    def get_data(self, params={}):
+    def get_data(self, params={}, limit=None):
         """
-        Retrieve a JSON object from a (parameterized) URL.
+        Retrieve a JSON object from a (parameterized) URL, going through the
+        result cache when one is configured.
 
         :param params: Dictionary mapping (string) query parameters to values
         :type params: dict
+        :param limit: Limit the fetch, if one is needed, runs under
+        :type limit: pygeobatch.AdaptiveLimit
         :return: JSON object with the data fetched from that URL as a JSON-format object.
         :rtype: (dict or array)
 
         """
-        request = requests.Request(
-            'GET',
-            url=Geocoder.GEOCODE_QUERY_URL,
-            params=params,
-            headers={
-                'User-Agent': Geocoder.USER_AGENT
-            })
-
-        if self and self.client_id and self.private_key:
-            request = self.add_signature(request)
-        elif self and self.api_key:
-            request.params['key'] = self.api_key
-
-        session = requests.Session()
-
-        if self and self.proxy:
-            session.proxies = {'https': self.proxy}
+        if self is not None:
+            fetch = functools.partial(self.fetch_data, params=params)
+        else:
+            fetch = functools.partial(Geocoder.fetch_data, params=params)
+        if limit is not None:
+            fetch = functools.partial(limit.call, fetch)
+        if self and self.result_cache is not None:
+            from pygeocache import cache_key
+            return self.result_cache.get(cache_key(params), fetch)
+        return fetch()
 
-        response = session.send(request.prepare())
-        session.close()
+    @omnimethod
+    def fetch_data(self, params={}):
+        """
+        Retrieve a JSON object from a (parameterized) URL, bypassing any cache.
 
-        if response.status_code == 403:
-            raise GeocoderError("Forbidden, 403", response.url)
-        response_json = response.json()
+        :param params: Dictionary mapping (string) query parameters to values
+        :type params: dict
+        :return: JSON object with the data fetched from that URL as a JSON-format object.
+        :rtype: (dict or array)
 
-        if response_json['status'] != GeocoderError.G_GEO_OK:
-            raise GeocoderError(response_json['status'], response.url)
-        return response_json['results']
+        """
+        import requests
+
+        with _phase(self, 'fetch'):
+            request = requests.Request(
+                'GET',
+                url=Geocoder.GEOCODE_QUERY_URL,
+                # a copy, since the API key is added to it below
+                params=dict(params),
+                headers={
+                    'User-Agent': Geocoder.USER_AGENT
+                })
+
+            if self and self.client_id and self.private_key:
+                with _phase(self, 'signature'):
+                    request = self.add_signature(request)
+            elif self and self.api_key:
+                request.params['key'] = self.api_key
+
+            with _phase(self, 'prepare'):
+                prepared = request.prepare()
+
+            if self and self.transport is not None:
+                transport = self.transport
+            else:
+                from pygeotransport import HTTPTransport
+                transport = HTTPTransport()
+            proxies = {'https': self.proxy} if self and self.proxy else None
+
+            with _phase(self, 'send'):
+                response = transport.send(prepared, proxies)
+                if self and self.profiler is not None:
+                    self.profiler.record('server', response.elapsed.total_seconds())
+
+            if response.status_code == 403:
+                raise GeocoderError("Forbidden, 403", response.url)
+            if response.status_code == 429:
+                # rate limited before the API could answer with a status
+                raise GeocoderError(GeocoderError.G_GEO_OVER_QUERY_LIMIT, response.url,
+                                    status_code=response.status_code)
+            if response.status_code >= 500:
+                raise GeocoderError(GeocoderError.G_HTTP_SERVER_ERROR, response.url,
+                                    status_code=response.status_code)
+            if response.status_code != 200:
+                raise GeocoderError(GeocoderError.G_HTTP_ERROR, response.url,
+                                    status_code=response.status_code)
+            with _phase(self, 'decode'):
+                response_json = response.json()
+
+            if response_json['status'] != GeocoderError.G_GEO_OK:
+                raise GeocoderError(response_json['status'], response.url)
+            return response_json['results']
 
     def add_signature(self, request):
         """
@@ -222,6 +385,15 @@ class Geocoder(object):
         See https://developers.google.com/maps/documentation/business/webservices/auth#signature_examples
         :return: requests.Request object of type 'GET'
         """
+        import base64
+        import hashlib
+        import hmac
+        import requests
+        try:
+            from urllib.parse import urlparse
+        except ImportError:
+            from urlparse import urlparse
+
         inputStr = request.prepare().url + '&client=' + self.client_id
         url = urlparse(inputStr)
         urlToSign = url.path + "?" + url.query
@@ -244,6 +416,11 @@ if __name__ == "__main__":
     import sys
     from optparse import OptionParser
 
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+
     def main():
         """
         Geocodes a location given on the command line.
@@ -259,6 +436,10 @@ if __name__ == "__main__":
         usage = "usage: %prog [options] address"
         parser = OptionParser(usage, version=VERSION)
         parser.add_option("-k", "--key", dest="key", help="Your Google Maps API key")
+        parser.add_option("--profile", action="store_true", dest="profile", default=False,
+                          help="Print time spent in each phase of the lookup to stderr")
+        parser.add_option("--profile-trace", dest="profile_trace", metavar="FILE",
+                          help="Write phase timings to FILE as folded stacks for flamegraph tools")
         (options, args) = parser.parse_args()
 
         if len(args) != 1:
@@ -266,7 +447,7 @@ if __name__ == "__main__":
             sys.exit(1)
 
         query = args[0]
-        gcoder = Geocoder(options.key)
+        gcoder = Geocoder(options.key, profile=bool(options.profile or options.profile_trace))
 
         try:
             result = gcoder.geocode(query)
@@ -274,6 +455,12 @@ if __name__ == "__main__":
             sys.stderr.write('%s\n%s\nResponse:\n' % (err.url, err))
             json.dump(err.response, sys.stderr, indent=4)
             sys.exit(1)
+        finally:
+            if options.profile:
+                sys.stderr.write(gcoder.profiler.report())
+            if options.profile_trace:
+                with open(options.profile_trace, 'w') as trace:
+                    trace.write(gcoder.profiler.folded())
 
         print(result)
         print(result.coordinates)
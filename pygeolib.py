@@ -1,5 +1,7 @@
 import sys
 import collections
+import functools
+import re
 
 
 class GeocoderResult(collections.Iterator):
@@ -80,6 +82,12 @@ class GeocoderResult(collections.Iterator):
         def next(self):
             return self.return_next()
 
+    def __reduce__(self):
+        """
+        Pickle the raw results and the iteration position only.
+        """
+        return (_unpack_result, (self.data, self.current_index))
+
     @property
     def count(self):
         return self.len
@@ -127,20 +135,120 @@ class GeocoderResult(collections.Iterator):
         return self.current_data['formatted_address']
 
     def __getattr__(self, name):
-        lookup = name.split('__')
-        attribute = lookup[0]
+        return _component(self.current_data, name)
+
+
+def _component(data, name):
+    """
+    Look up address component `name` of a single raw result, see
+    :class:`GeocoderResult`.
+    """
+    lookup = name.split('__')
+    attribute = lookup[0]
+
+    if (attribute in GeocoderResult.attribute_mapping):
+        attribute = GeocoderResult.attribute_mapping[attribute]
+
+    try:
+        prop = lookup[1]
+    except IndexError:
+        prop = 'long_name'
 
-        if (attribute in GeocoderResult.attribute_mapping):
-            attribute = GeocoderResult.attribute_mapping[attribute]
+    for elem in data['address_components']:
+        if attribute in elem['types']:
+            return elem[prop]
 
-        try:
-            prop = lookup[1]
-        except IndexError:
-            prop = 'long_name'
 
-        for elem in self.current_data['address_components']:
-            if attribute in elem['types']:
-                return elem[prop]
+def _location(data):
+    location = data['geometry']['location']
+    return location['lat'], location['lng']
+
+_FIELD_GETTERS = {
+    'coordinates': _location,
+    'latitude': lambda data: _location(data)[0],
+    'longitude': lambda data: _location(data)[1],
+    'location_type': lambda data: data['geometry']['location_type'],
+    'viewport': lambda data: data['geometry'].get('viewport'),
+    'valid_address': lambda data: (data['types'] == [u'street_address'] or
+                                   data['types'] == [u'premise']),
+}
+
+_FIELD_NAME = re.compile(r'^[a-z][a-z0-9_]*$')
+
+_record_types = {}
+
+
+def record_type(fields):
+    """
+    Return the slim result type holding `fields`, a named tuple class shared
+    by every projection onto the same fields.
+
+    :param fields: Field names, e.g. ``('coordinates', 'postal_code')``
+    :type fields: tuple of string
+    :raises ValueError: if a field name is not a valid attribute name
+    """
+    fields = tuple(fields)
+    cls = _record_types.get(fields)
+    if cls is None:
+        for name in fields:
+            if not _FIELD_NAME.match(name):
+                raise ValueError("invalid field name %r" % name)
+        cls = collections.namedtuple('GeocoderRecord', fields)
+        # the class is not a module attribute, so pickle rebuilds it by fields
+        cls.__reduce__ = _reduce_record
+        _record_types[fields] = cls
+    return cls
+
+
+def _reduce_record(record):
+    return (_make_record, (record._fields, tuple(record)))
+
+
+def _make_record(fields, values):
+    """
+    Rebuild a pickled :func:`record_type` instance.
+    """
+    return record_type(fields)._make(values)
+
+
+def project(data, fields):
+    """
+    Keep only `fields` of every raw result in `data`.
+
+    A field is one of the :class:`GeocoderResult` properties ``coordinates``,
+    ``latitude``, ``longitude``, ``location_type``, ``valid_address``, a
+    ``viewport``, a top level key of the raw result such as
+    ``formatted_address`` or ``place_id``, or an address component lookup
+    such as ``postal_code`` or ``state__short_name``.
+
+    :param data: Results list, as held in :attr:`GeocoderResult.raw`
+    :param fields: Field names
+    :rtype: list of :func:`record_type` instances
+    """
+    cls = record_type(fields)
+    getters = []
+    for name in cls._fields:
+        getter = _FIELD_GETTERS.get(name)
+        if getter is None:
+            getter = functools.partial(_field, name)
+        getters.append(getter)
+    return [cls._make([getter(result) for getter in getters]) for result in data]
+
+
+def _field(name, data):
+    if name in data:
+        return data[name]
+    return _component(data, name)
+
+
+def _unpack_result(data, current_index=0):
+    """
+    Rebuild a pickled :class:`GeocoderResult`, keeping its iteration state.
+    """
+    result = GeocoderResult(data)
+    result.current_index = current_index
+    result.current_data = result.data[max(current_index - 1, 0)]
+    return result
 
 
 class GeocoderError(Exception):
@@ -156,8 +264,11 @@ class GeocoderError(Exception):
     G_GEO_OVER_QUERY_LIMIT = "OVER_QUERY_LIMIT"
     G_GEO_REQUEST_DENIED = "REQUEST_DENIED"
     G_GEO_MISSING_QUERY = "INVALID_REQUEST"
+    #: Statuses of HTTP error responses, which carry no body to read one from
+    G_HTTP_SERVER_ERROR = "SERVER_ERROR"
+    G_HTTP_ERROR = "HTTP_ERROR"
 
-    def __init__(self, status, url=None, response=None):
+    def __init__(self, status, url=None, response=None, status_code=None):
         """Create an exception with a status and optional full response.
 
         :param status: Either a ``G_GEO_`` code or a string explaining the
@@ -167,15 +278,20 @@ class GeocoderError(Exception):
         :type url: string
         :param response: The actual response returned from Google, if any.
         :type response: dict
+        :param status_code: The HTTP status of an error response, if any.
+        :type status_code: int
 
         """
         Exception.__init__(self, status) # Exception is an old-school class
         self.status = status
         self.url = url
         self.response = response
+        self.status_code = status_code
 
     def __str__(self):
         """Return a string representation of this :exc:`GeocoderError`."""
+        if self.status_code is not None:
+            return 'Error %s (HTTP %d)\nQuery: %s' % (self.status, self.status_code, self.url)
         return 'Error %s\nQuery: %s' % (self.status, self.url)
 
     def __unicode__(self):
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Vectorized geometry on batches of geocoder results. Requires NumPy.
+
+Points are ``(n, 2)`` arrays of (latitude, longitude) in degrees, as returned
+by :func:`coordinates`. Distances are in meters on a spherical Earth.
+
+Example:
+
+    points = coordinates(Geocoder.batch_geocode(addresses, fields=('coordinates',)))
+    meters = haversine_to(points, depot)
+    Geocoder.geocode('main street', bounds=bounds_string(bounding_box(points)))
+
+Boxes are ``(south, west, north, east)`` tuples. Boxes crossing the
+antimeridian are not supported.
+"""
+
+import numpy as np
+
+__all__ = ['EARTH_RADIUS', 'coordinates', 'haversine', 'haversine_to',
+           'haversine_matrix', 'bounding_box', 'viewport_union',
+           'bounds_string', 'cluster']
+
+#: Mean Earth radius in meters
+EARTH_RADIUS = 6371008.8
+
+# meters per degree of latitude
+_METERS_PER_DEGREE = EARTH_RADIUS * np.pi / 180
+
+
+def coordinates(results):
+    """
+    Return the coordinates of every result as an ``(n, 2)`` float array.
+
+    Exceptions, which :meth:`Geocoder.batch_geocode` returns in place of
+    failed lookups, are skipped, so rows no longer line up with the input.
+
+    :param results: :class:`GeocoderResult` objects (each contributes every
+        result it holds), records projected with a ``coordinates`` field
+        (single or in lists), raw result dicts, or (latitude, longitude) pairs.
+    :rtype: numpy.ndarray
+    :raises ValueError: for projected records without ``coordinates``
+    """
+    points = []
+    for item in results:
+        _collect(item, points)
+    return _as_points(points)
+
+
+def _collect(item, points):
+    if isinstance(item, Exception):
+        return
+    if hasattr(item, 'raw'):
+        for result in item.raw:
+            location = result['geometry']['location']
+            points.append((location['lat'], location['lng']))
+    elif hasattr(item, '_fields'):
+        if 'coordinates' not in item._fields:
+            raise ValueError("projected records need the 'coordinates' field")
+        points.append(item.coordinates)
+    elif isinstance(item, dict):
+        location = item['geometry']['location']
+        points.append((location['lat'], location['lng']))
+    elif isinstance(item, list) and all(hasattr(record, '_fields') for record in item):
+        # projections of every result of one lookup
+        for record in item:
+            _collect(record, points)
+    else:
+        points.append(item)
+
+
+def _as_points(points):
+    points = np.asarray(points, dtype=np.float64)
+    if points.size == 0:
+        return points.reshape(0, 2)
+    if points.ndim == 1:
+        points = points.reshape(1, 2)
+    if points.ndim != 2 or points.shape[1] != 2:
+        raise ValueError("points must have shape (n, 2)")
+    return points
+
+
+def _haversine(lat1, lng1, lat2, lng2):
+    # inputs in radians, broadcast against each other
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def haversine(a, b):
+    """
+    Return the distance between each point of `a` and the matching point of
+    `b`.
+
+    :param a: ``(n, 2)`` points
+    :param b: ``(n, 2)`` points
+    :rtype: ``(n,)`` numpy.ndarray of meters
+    """
+    a = np.radians(_as_points(a))
+    b = np.radians(_as_points(b))
+    if a.shape != b.shape:
+        raise ValueError("a and b must hold the same number of points")
+    return _haversine(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+
+
+def haversine_to(points, origin):
+    """
+    Return the distance from every point to a single `origin`.
+
+    :param points: ``(n, 2)`` points
+    :param origin: (latitude, longitude) pair
+    :rtype: ``(n,)`` numpy.ndarray of meters
+    """
+    points = np.radians(_as_points(points))
+    lat, lng = np.radians(np.asarray(origin, dtype=np.float64))
+    return _haversine(points[:, 0], points[:, 1], lat, lng)
+
+
+def haversine_matrix(a, b=None):
+    """
+    Return the distance between every point of `a` and every point of `b`.
+
+    :param a: ``(n, 2)`` points
+    :param b: ``(m, 2)`` points, defaults to `a`
+    :rtype: ``(n, m)`` numpy.ndarray of meters
+    """
+    a = np.radians(_as_points(a))
+    b = a if b is None else np.radians(_as_points(b))
+    return _haversine(a[:, 0, None], a[:, 1, None], b[None, :, 0], b[None, :, 1])
+
+
+def bounding_box(points):
+    """
+    Return the smallest box enclosing every point.
+
+    :param points: ``(n, 2)`` points, at least one
+    :rtype: (south, west, north, east) tuple
+    """
+    points = _as_points(points)
+    if not len(points):
+        raise ValueError("cannot bound an empty set of points")
+    south, west = points.min(axis=0)
+    north, east = points.max(axis=0)
+    return float(south), float(west), float(north), float(east)
+
+
+def viewport_union(results):
+    """
+    Return the smallest box enclosing the viewport of every result.
+
+    :param results: :class:`GeocoderResult` objects or raw result dicts
+    :rtype: (south, west, north, east) tuple
+    """
+    corners = []
+    for item in results:
+        for result in (item.raw if hasattr(item, 'raw') else [item]):
+            viewport = result['geometry']['viewport']
+            corners.append((viewport['southwest']['lat'], viewport['southwest']['lng']))
+            corners.append((viewport['northeast']['lat'], viewport['northeast']['lng']))
+    return bounding_box(corners)
+
+
+def bounds_string(box):
+    """
+    Format a box as the ``bounds`` parameter of :meth:`Geocoder.geocode`.
+
+    :param box: (south, west, north, east) tuple
+    :rtype: string
+    """
+    return '%f,%f|%f,%f' % tuple(box)
+
+
+def cluster(points, cell_size=25.0):
+    """
+    Group near-duplicate points by snapping them to a grid of square cells
+    `cell_size` meters wide. Points in the same cell share a label; two close
+    points on either side of a cell edge get different labels.
+
+    :param points: ``(n, 2)`` points
+    :param cell_size: Cell width in meters
+    :return: ``(n,)`` integer labels, numbered in order of first appearance
+    :rtype: numpy.ndarray
+    """
+    points = _as_points(points)
+    if not len(points):
+        return np.zeros(0, dtype=np.intp)
+    lat_step = cell_size / _METERS_PER_DEGREE
+    rows = np.floor(points[:, 0] / lat_step)
+    # longitude cells shrink with the cosine of the latitude of their row
+    row_lat = np.radians((rows + 0.5) * lat_step)
+    lng_step = lat_step / np.maximum(np.cos(row_lat), 1e-12)
+    cols = np.floor(points[:, 1] / lng_step)
+    cells = np.stack([rows, cols], axis=1)
+    _, first, labels = np.unique(cells, axis=0, return_index=True, return_inverse=True)
+    labels = labels.reshape(-1)
+    # renumber so labels follow the input order
+    order = np.argsort(first)
+    renumber = np.empty_like(order)
+    renumber[order] = np.arange(len(order))
+    return renumber[labels]
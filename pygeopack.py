@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Compact binary encoding of raw geocoder results.
+
+:func:`dumps` turns the results list held in :attr:`GeocoderResult.raw` into
+bytes and :func:`loads` turns them back into an equal list of dicts.
+:class:`PackedResults` reads fields straight out of an encoded buffer, such as
+an ``mmap``, without decoding the rest of it.
+
+Every string is stored once in a shared table. Coordinates are packed as
+doubles, and a ``types`` list made of well known types in their usual order
+is stored as a 64 bit mask. Keys this format does not know about are kept as
+compact JSON, so the round trip is lossless.
+
+Layout, all little-endian:
+
+* header: magic, string count, result count
+* string offsets (count + 1 uint32) followed by the UTF-8 string data
+* result offsets (count + 1 uint32) followed by the result records
+
+"""
+
+import struct
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__all__ = ['dumps', 'loads', 'PackedResults', 'TYPES']
+
+MAGIC = b'PGR1'
+
+#: Types encoded as a bit mask, in the order Google usually lists them.
+TYPES = (
+    'street_address', 'route', 'intersection', 'premise', 'subpremise',
+    'street_number', 'floor', 'room', 'post_box', 'plus_code',
+    'postal_code', 'postal_code_prefix', 'postal_code_suffix', 'postal_town',
+    'colloquial_area', 'locality', 'neighborhood', 'ward', 'country',
+    'administrative_area_level_1', 'administrative_area_level_2',
+    'administrative_area_level_3', 'administrative_area_level_4',
+    'administrative_area_level_5', 'political', 'sublocality',
+    'sublocality_level_1', 'sublocality_level_2', 'sublocality_level_3',
+    'sublocality_level_4', 'sublocality_level_5', 'natural_feature',
+    'airport', 'park', 'bus_station', 'train_station', 'transit_station',
+    'point_of_interest', 'establishment', 'geocode', 'parking', 'store',
+    'food', 'health', 'place_of_worship', 'university', 'school',
+    'hospital', 'lodging', 'restaurant', 'finance', 'general_contractor',
+)
+_TYPE_BITS = dict((name, index) for index, name in enumerate(TYPES))
+
+_HEADER = struct.Struct('<4sII')
+_UINT8 = struct.Struct('<B')
+_UINT16 = struct.Struct('<H')
+_UINT32 = struct.Struct('<I')
+_UINT64 = struct.Struct('<Q')
+_POINT = struct.Struct('<dd')
+_BOX = struct.Struct('<dddd')
+_COMPONENT = struct.Struct('<II')
+
+# record flags, in the order their fields follow the flags byte
+_LOCATION = 0x01
+_VIEWPORT = 0x02
+_BOUNDS = 0x04
+_LOCATION_TYPE = 0x08
+_FORMATTED_ADDRESS = 0x10
+_TYPES = 0x20
+_COMPONENTS = 0x40
+_EXTRAS = 0x80
+
+# type list modes
+_TYPES_MASK = 0
+_TYPES_LIST = 1
+
+_text = type(u'')
+
+# type bit mask -> decoded types, filled as masks are seen
+_MASK_TYPES = {}
+
+
+def _is_point(value):
+    return (isinstance(value, dict) and len(value) == 2 and
+            type(value.get('lat')) is float and type(value.get('lng')) is float)
+
+
+def _is_box(value):
+    return (isinstance(value, dict) and len(value) == 2 and
+            _is_point(value.get('northeast')) and _is_point(value.get('southwest')))
+
+
+def _is_type_list(value):
+    return isinstance(value, list) and all(isinstance(name, _text) for name in value)
+
+
+def _packable_geometry(geometry):
+    if not isinstance(geometry, dict) or not _is_point(geometry.get('location')):
+        return False
+    for key, value in geometry.items():
+        if key in ('viewport', 'bounds'):
+            if not _is_box(value):
+                return False
+        elif key == 'location_type':
+            if not isinstance(value, _text):
+                return False
+        elif key != 'location':
+            return False
+    return True
+
+
+def _packable_components(components):
+    if not isinstance(components, list):
+        return False
+    for component in components:
+        if (not isinstance(component, dict) or len(component) != 3 or
+                not isinstance(component.get('long_name'), _text) or
+                not isinstance(component.get('short_name'), _text) or
+                not _is_type_list(component.get('types'))):
+            return False
+    return True
+
+
+class _Encoder(object):
+
+    def __init__(self):
+        self.strings = []
+        self.string_index = {}
+
+    def intern(self, value):
+        index = self.string_index.get(value)
+        if index is None:
+            index = self.string_index[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def pack_types(self, out, types):
+        mask = 0
+        last = -1
+        for name in types:
+            bit = _TYPE_BITS.get(name, -1)
+            if bit <= last:
+                break
+            mask |= 1 << bit
+            last = bit
+        else:
+            out += _UINT8.pack(_TYPES_MASK)
+            out += _UINT64.pack(mask)
+            return
+        out += _UINT8.pack(_TYPES_LIST)
+        out += _UINT16.pack(len(types))
+        for name in types:
+            out += _UINT32.pack(self.intern(name))
+
+    def pack_result(self, out, result):
+        extras = dict(result)
+        flags = 0
+        geometry = extras.get('geometry')
+        if _packable_geometry(geometry):
+            del extras['geometry']
+            flags |= _LOCATION
+            if 'viewport' in geometry:
+                flags |= _VIEWPORT
+            if 'bounds' in geometry:
+                flags |= _BOUNDS
+            if 'location_type' in geometry:
+                flags |= _LOCATION_TYPE
+        formatted_address = extras.get('formatted_address')
+        if isinstance(formatted_address, _text):
+            del extras['formatted_address']
+            flags |= _FORMATTED_ADDRESS
+        types = extras.get('types')
+        if _is_type_list(types):
+            del extras['types']
+            flags |= _TYPES
+        components = extras.get('address_components')
+        if _packable_components(components):
+            del extras['address_components']
+            flags |= _COMPONENTS
+        if extras:
+            flags |= _EXTRAS
+
+        out += _UINT8.pack(flags)
+        if flags & _LOCATION:
+            location = geometry['location']
+            out += _POINT.pack(location['lat'], location['lng'])
+            for flag, key in ((_VIEWPORT, 'viewport'), (_BOUNDS, 'bounds')):
+                if flags & flag:
+                    box = geometry[key]
+                    out += _BOX.pack(box['northeast']['lat'], box['northeast']['lng'],
+                                     box['southwest']['lat'], box['southwest']['lng'])
+            if flags & _LOCATION_TYPE:
+                out += _UINT32.pack(self.intern(geometry['location_type']))
+        if flags & _FORMATTED_ADDRESS:
+            out += _UINT32.pack(self.intern(formatted_address))
+        if flags & _TYPES:
+            self.pack_types(out, types)
+        if flags & _COMPONENTS:
+            out += _UINT16.pack(len(components))
+            for component in components:
+                out += _COMPONENT.pack(self.intern(component['long_name']),
+                                       self.intern(component['short_name']))
+                self.pack_types(out, component['types'])
+        if flags & _EXTRAS:
+            out += _UINT32.pack(self.intern(
+                json.dumps(extras, separators=(',', ':'), sort_keys=True)))
+
+
+def dumps(data):
+    """
+    Encode a list of raw geocoder results.
+
+    :param data: Results list, as held in :attr:`GeocoderResult.raw`
+    :type data: list of dict
+    :rtype: bytes
+    """
+    encoder = _Encoder()
+    records = bytearray()
+    offsets = [0]
+    for result in data:
+        encoder.pack_result(records, result)
+        offsets.append(len(records))
+
+    encoded = [value.encode('utf-8') for value in encoder.strings]
+    out = bytearray(_HEADER.pack(MAGIC, len(encoded), len(data)))
+    position = 0
+    out += _UINT32.pack(position)
+    for value in encoded:
+        position += len(value)
+        out += _UINT32.pack(position)
+    out += b''.join(encoded)
+    out += struct.pack('<%dI' % len(offsets), *offsets)
+    out += records
+    return bytes(out)
+
+
+def loads(buf):
+    """
+    Decode bytes produced by :func:`dumps` back into a list of raw results.
+
+    :param buf: Encoded results
+    :type buf: bytes, bytearray, memoryview or mmap
+    :rtype: list of dict
+    """
+    return PackedResults(buf).to_list()
+
+
+class PackedResults(object):
+    """
+    Read-only view over results encoded by :func:`dumps`.
+
+    Nothing is decoded up front: each accessor reads only the bytes it needs
+    from the underlying buffer, so a large ``mmap`` can be queried without
+    loading it.
+
+    Example:
+
+        with open('results.bin', 'rb') as f:
+            packed = PackedResults(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            lat, lng = packed.coordinates(0)
+
+    """
+
+    def __init__(self, buf):
+        self.buf = memoryview(buf)
+        magic, self.string_count, self.count = _HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ValueError("not a packed geocoder result buffer")
+        self._string_offsets = _HEADER.size
+        self._strings = self._string_offsets + (self.string_count + 1) * _UINT32.size
+        string_end, = _UINT32.unpack_from(self.buf, self._string_offsets + self.string_count * _UINT32.size)
+        self._result_offsets = self._strings + string_end
+        self._results = self._result_offsets + (self.count + 1) * _UINT32.size
+        self._table = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """
+        Decode result number `index` into a dict.
+        """
+        return self._decode(self._record(index))
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self[index]
+
+    def to_list(self):
+        """
+        Decode every result.
+        """
+        self.strings()
+        return [self._decode(self._record(index)) for index in range(self.count)]
+
+    def string(self, index):
+        """
+        Return entry `index` of the string table.
+        """
+        if self._table is not None:
+            return self._table[index]
+        start, end = struct.unpack_from('<II', self.buf, self._string_offsets + index * _UINT32.size)
+        return self.buf[self._strings + start:self._strings + end].tobytes().decode('utf-8')
+
+    def strings(self):
+        """
+        Decode the whole string table once; later reads are list lookups.
+        """
+        if self._table is None:
+            offsets = struct.unpack_from('<%dI' % (self.string_count + 1), self.buf, self._string_offsets)
+            data = self.buf[self._strings:self._strings + offsets[-1]].tobytes()
+            self._table = [data[offsets[index]:offsets[index + 1]].decode('utf-8')
+                           for index in range(self.string_count)]
+        return self._table
+
+    def coordinates(self, index):
+        """
+        Return the (latitude, longitude) pair of result number `index`, or
+        ``None`` when it has no location.
+        """
+        offset = self._record(index)
+        flags, = _UINT8.unpack_from(self.buf, offset)
+        if not flags & _LOCATION:
+            return None
+        return _POINT.unpack_from(self.buf, offset + 1)
+
+    def formatted_address(self, index):
+        """
+        Return the formatted address of result number `index`, or ``None``.
+        """
+        offset = self._record(index)
+        flags, = _UINT8.unpack_from(self.buf, offset)
+        if not flags & _FORMATTED_ADDRESS:
+            return None
+        offset += 1
+        if flags & _LOCATION:
+            offset += _POINT.size
+        if flags & _VIEWPORT:
+            offset += _BOX.size
+        if flags & _BOUNDS:
+            offset += _BOX.size
+        if flags & _LOCATION_TYPE:
+            offset += _UINT32.size
+        return self.string(_UINT32.unpack_from(self.buf, offset)[0])
+
+    def _record(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("packed result index out of range")
+        offset, = _UINT32.unpack_from(self.buf, self._result_offsets + index * _UINT32.size)
+        return self._results + offset
+
+    def _unpack_types(self, offset):
+        mode, = _UINT8.unpack_from(self.buf, offset)
+        offset += 1
+        if mode == _TYPES_MASK:
+            mask, = _UINT64.unpack_from(self.buf, offset)
+            types = _MASK_TYPES.get(mask)
+            if types is None:
+                types = _MASK_TYPES[mask] = tuple(
+                    name for bit, name in enumerate(TYPES) if mask >> bit & 1)
+            return list(types), offset + _UINT64.size
+        count, = _UINT16.unpack_from(self.buf, offset)
+        offset += _UINT16.size
+        indexes = struct.unpack_from('<%dI' % count, self.buf, offset)
+        return [self.string(index) for index in indexes], offset + count * _UINT32.size
+
+    def _unpack_box(self, offset):
+        ne_lat, ne_lng, sw_lat, sw_lng = _BOX.unpack_from(self.buf, offset)
+        return {
+            'northeast': {'lat': ne_lat, 'lng': ne_lng},
+            'southwest': {'lat': sw_lat, 'lng': sw_lng},
+        }
+
+    def _decode(self, offset):
+        result = {}
+        flags, = _UINT8.unpack_from(self.buf, offset)
+        offset += 1
+        if flags & _LOCATION:
+            lat, lng = _POINT.unpack_from(self.buf, offset)
+            offset += _POINT.size
+            geometry = result['geometry'] = {'location': {'lat': lat, 'lng': lng}}
+            if flags & _VIEWPORT:
+                geometry['viewport'] = self._unpack_box(offset)
+                offset += _BOX.size
+            if flags & _BOUNDS:
+                geometry['bounds'] = self._unpack_box(offset)
+                offset += _BOX.size
+            if flags & _LOCATION_TYPE:
+                geometry['location_type'] = self.string(_UINT32.unpack_from(self.buf, offset)[0])
+                offset += _UINT32.size
+        if flags & _FORMATTED_ADDRESS:
+            result['formatted_address'] = self.string(_UINT32.unpack_from(self.buf, offset)[0])
+            offset += _UINT32.size
+        if flags & _TYPES:
+            result['types'], offset = self._unpack_types(offset)
+        if flags & _COMPONENTS:
+            count, = _UINT16.unpack_from(self.buf, offset)
+            offset += _UINT16.size
+            components = result['address_components'] = []
+            for _ in range(count):
+                long_name, short_name = _COMPONENT.unpack_from(self.buf, offset)
+                types, offset = self._unpack_types(offset + _COMPONENT.size)
+                components.append({
+                    'long_name': self.string(long_name),
+                    'short_name': self.string(short_name),
+                    'types': types,
+                })
+        if flags & _EXTRAS:
+            result.update(json.loads(self.string(_UINT32.unpack_from(self.buf, offset)[0])))
+        return result
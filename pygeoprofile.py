@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Per-phase timing of :class:`pygeocoder.Geocoder` calls.
+
+Example:
+
+    geocoder = Geocoder(profile=True)
+    geocoder.geocode('1600 amphitheatre mountain view ca')
+    print(geocoder.profiler.report())
+    open('geocode.folded', 'w').write(geocoder.profiler.folded())
+
+Phases nest: a ``geocode`` call contains ``fetch``, which contains
+``signature``, ``prepare``, ``send`` and ``decode``. ``send`` covers the
+transport, including session creation. The ``server`` phase under ``send`` is
+``response.elapsed`` as measured by requests: from sending the request until
+the response headers arrived. It includes DNS, TCP and TLS setup when the
+request opens a new connection, which :class:`pygeotransport.HTTPTransport`
+does for every request; connection setup is not timed on its own.
+:meth:`Profiler.folded` output can be fed to flamegraph.pl or speedscope.
+
+Memory stays bounded however long the profiler runs: each phase keeps its
+call count and total time, and percentiles are computed from a uniform
+random sample of at most `reservoir` durations.
+"""
+
+import random
+import threading
+import time
+
+__all__ = ['Profiler', 'PhaseStats']
+
+try:
+    _timer = time.perf_counter
+except AttributeError:  # Python 2
+    _timer = time.time
+
+
+class _Phase(object):
+    __slots__ = ('profiler', 'name', 'path', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        stack.append(self.name)
+        self.path = tuple(stack)
+        self.start = self.profiler.timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = self.profiler.timer() - self.start
+        self.profiler._stack().pop()
+        self.profiler._add(self.path, elapsed)
+
+
+class PhaseStats(object):
+    """
+    Call count and total time of one phase, with a bounded uniform sample of
+    its durations in `samples`.
+    """
+    __slots__ = ('count', 'total', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.samples = []
+
+
+class Profiler(object):
+    """
+    Collects the duration of nested phases, per thread, keyed by their path
+    from the outermost phase, e.g. ``('geocode', 'fetch', 'send')``.
+    """
+
+    def __init__(self, timer=_timer, reservoir=1000, seed=None):
+        """
+        :param timer: Function returning the current time in seconds
+        :param reservoir: Durations kept per phase for percentiles
+        :type reservoir: int
+        :param seed: Seed of the reservoir sampling
+        """
+        self.timer = timer
+        self.reservoir = reservoir
+        self.phases = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = []
+            return stack
+
+    def phase(self, name):
+        """
+        Return a context manager timing phase `name` inside the current one.
+        """
+        return _Phase(self, name)
+
+    def record(self, name, seconds):
+        """
+        Record a duration measured elsewhere as phase `name` inside the
+        current one.
+        """
+        self._add(tuple(self._stack()) + (name,), seconds)
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+    def _snapshot(self):
+        # batch worker threads add phases while a report is taken
+        with self._lock:
+            return [(path, stats.count, stats.total, sorted(stats.samples))
+                    for path, stats in sorted(self.phases.items())]
+
+    def _add(self, path, seconds):
+        with self._lock:
+            stats = self.phases.get(path)
+            if stats is None:
+                stats = self.phases[path] = PhaseStats()
+            stats.count += 1
+            stats.total += seconds
+            if len(stats.samples) < self.reservoir:
+                stats.samples.append(seconds)
+            else:
+                # reservoir sampling keeps every duration equally likely
+                slot = self._random.randrange(stats.count)
+                if slot < self.reservoir:
+                    stats.samples[slot] = seconds
+
+    def percentiles(self, path, percents=(50, 90, 99)):
+        """
+        Return the given percentiles, in seconds, of the durations recorded
+        for `path`, estimated from the sampled durations once a phase ran
+        more than `reservoir` times.
+
+        :param path: Phase path, as a tuple of names or a ``;`` joined string
+        :rtype: dict mapping each percent to seconds
+        """
+        if not isinstance(path, tuple):
+            path = tuple(path.split(';'))
+        with self._lock:
+            stats = self.phases.get(path)
+            values = sorted(stats.samples) if stats is not None else []
+        return dict((percent, _percentile(values, percent)) for percent in percents)
+
+    def report(self, percents=(50, 90, 99)):
+        """
+        Return a text table with call counts, totals and percentiles per phase,
+        in milliseconds, with nested phases indented under their parent.
+        """
+        header = ['%-32s %7s %10s %9s' % ('phase', 'calls', 'total ms', 'mean ms')]
+        header.extend('%8s' % ('p%d ms' % percent) for percent in percents)
+        lines = [' '.join(header)]
+        for path, count, total, values in self._snapshot():
+            row = ['%-32s %7d %10.3f %9.3f' % ('  ' * (len(path) - 1) + path[-1],
+                                                count, total * 1000, total * 1000 / count)]
+            row.extend('%8.3f' % (_percentile(values, percent) * 1000) for percent in percents)
+            lines.append(' '.join(row))
+        return '\n'.join(lines) + '\n'
+
+    def folded(self):
+        """
+        Return the self time of every phase in the folded stack format
+        (``geocode;fetch;send 1234``) used by flamegraph tools, in
+        microseconds.
+        """
+        totals = dict((path, total) for path, count, total, values in self._snapshot())
+        own = dict(totals)
+        for path, total in totals.items():
+            if len(path) > 1 and path[:-1] in own:
+                own[path[:-1]] -= total
+        return ''.join('%s %d\n' % (';'.join(path), max(int(round(seconds * 1e6)), 0))
+                       for path, seconds in sorted(own.items()))
+
+
+def _percentile(values, percent):
+    # linear interpolation between closest ranks of sorted values
+    if not values:
+        return 0.0
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Incremental bulk geocoding.
+
+A :class:`ResultStore` keeps, for each input row, the raw results of its last
+lookup next to a hash of the query parameters that produced them.
+:func:`incremental_geocode` then only queries rows which are new, whose
+parameters changed or whose result is older than `max_age`, and reports the
+results whose coordinates or formatted address moved.
+
+Example:
+
+    store = ResultStore('customers.db')
+    rows = ((customer.id, {'address': customer.address, 'region': 'us'})
+            for customer in customers)
+    report = incremental_geocode(Geocoder(), rows, store, max_age=90 * 86400)
+    for change in report.changes:
+        print(change.row_id, change.old_address, '->', change.new_address)
+
+"""
+
+import hashlib
+import math
+import sqlite3
+import time
+from collections import namedtuple
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import pygeopack
+from pygeobatch import as_limit, map_batch
+
+__all__ = ['ResultStore', 'IncrementalReport', 'ResultChange',
+           'incremental_geocode', 'query_digest']
+
+#: Query parameters included in the content hash of a row
+HASHED_PARAMS = ('address', 'bounds', 'region', 'language', 'components')
+
+#: A stored result which moved, see :attr:`IncrementalReport.changes`
+ResultChange = namedtuple('ResultChange', [
+    'row_id', 'reason', 'distance',
+    'old_coordinates', 'new_coordinates', 'old_address', 'new_address'])
+
+# rows looked up in the store per query
+_CHUNK = 500
+
+
+def query_digest(params):
+    """
+    Return the content hash of the query parameters of a row. Missing
+    parameters hash like empty ones, as :meth:`Geocoder.geocode` sends them.
+
+    :param params: Keyword arguments for :meth:`Geocoder.geocode`
+    :type params: dict
+    :rtype: string
+    """
+    hashed = [params.get(name) or '' for name in HASHED_PARAMS]
+    return hashlib.sha1(json.dumps(hashed).encode('utf-8')).hexdigest()
+
+
+class ResultStore(object):
+    """
+    SQLite table of the latest raw results of each row, stored with
+    :mod:`pygeopack`.
+    """
+
+    def __init__(self, path=':memory:'):
+        """
+        :param path: Database file, in memory by default
+        :type path: string
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'row_id PRIMARY KEY, digest TEXT NOT NULL, '
+            'stored_at REAL NOT NULL, raw BLOB NOT NULL)')
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def digests(self, row_ids):
+        """
+        Return a dictionary mapping each stored row of `row_ids` to its
+        (digest, stored_at) pair.
+        """
+        found = {}
+        row_ids = list(row_ids)
+        for start in range(0, len(row_ids), _CHUNK):
+            chunk = row_ids[start:start + _CHUNK]
+            cursor = self.connection.execute(
+                'SELECT row_id, digest, stored_at FROM results WHERE row_id IN (%s)'
+                % ','.join('?' * len(chunk)), chunk)
+            for row_id, digest, stored_at in cursor:
+                found[row_id] = (digest, stored_at)
+        return found
+
+    def get(self, row_id):
+        """
+        Return the raw results stored for `row_id`, or ``None``.
+
+        :rtype: list of dict
+        """
+        row = self.connection.execute(
+            'SELECT raw FROM results WHERE row_id = ?', (row_id,)).fetchone()
+        return pygeopack.loads(row[0]) if row is not None else None
+
+    def put(self, row_id, digest, data, stored_at=None):
+        """
+        Store the raw results of `row_id` with the digest of their query.
+        """
+        if stored_at is None:
+            stored_at = time.time()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO results (row_id, digest, stored_at, raw) VALUES (?, ?, ?, ?)',
+            (row_id, digest, stored_at, sqlite3.Binary(pygeopack.dumps(data))))
+
+    def delete(self, row_id):
+        self.connection.execute('DELETE FROM results WHERE row_id = ?', (row_id,))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+class IncrementalReport(object):
+    """
+    Outcome of :func:`incremental_geocode`.
+
+    * `unchanged`: row ids skipped because their query and result are current
+    * `queried`: row ids geocoded and stored, with the reason in `reasons`
+      (``'new'``, ``'changed'`` or ``'expired'``)
+    * `failed`: row id to the exception raised; their stored result is kept
+    * `changes`: a :class:`ResultChange` per previously stored row whose
+      coordinates or formatted address moved
+    """
+
+    def __init__(self):
+        self.unchanged = []
+        self.queried = []
+        self.reasons = {}
+        self.failed = {}
+        self.changes = []
+
+    def __repr__(self):
+        return '<IncrementalReport unchanged=%d queried=%d failed=%d changes=%d>' % (
+            len(self.unchanged), len(self.queried), len(self.failed), len(self.changes))
+
+
+def _first(data):
+    if not data:
+        return None, None
+    location = data[0]['geometry']['location']
+    return (location['lat'], location['lng']), data[0].get('formatted_address')
+
+
+def _distance(a, b):
+    # haversine distance in meters
+    lat1, lng1, lat2, lng2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * 6371008.8 * math.asin(min(1.0, math.sqrt(h)))
+
+
+def _compare(report, store, row_id, reason, data, min_distance):
+    old_coordinates, old_address = _first(store.get(row_id))
+    new_coordinates, new_address = _first(data)
+    if old_coordinates is not None and new_coordinates is not None:
+        distance = _distance(old_coordinates, new_coordinates)
+    else:
+        distance = None
+    if ((distance is None and old_coordinates != new_coordinates) or
+            (distance is not None and distance >= min_distance) or
+            old_address != new_address):
+        report.changes.append(ResultChange(
+            row_id, reason, distance,
+            old_coordinates, new_coordinates, old_address, new_address))
+
+
+def incremental_geocode(geocoder, rows, store, max_age=None, min_distance=1.0,
+                        concurrency=None, clock=time.time):
+    """
+    Geocode only the rows whose query changed since they were stored, or
+    whose stored result is older than `max_age`, and store the new results.
+
+    :param geocoder: Geocoder used for the lookups
+    :type geocoder: pygeocoder.Geocoder
+    :param rows: (row_id, params) pairs, where params are keyword arguments
+        for :meth:`Geocoder.geocode`
+    :param store: Results of previous runs, updated in place
+    :type store: ResultStore
+    :param max_age: Seconds after which a stored result is queried again
+    :type max_age: float
+    :param min_distance: Meters the first result must move to count as a change
+    :type min_distance: float
+    :param concurrency: As for :meth:`Geocoder.batch_geocode`
+    :rtype: IncrementalReport
+
+    Results are stored and committed every few hundred rows. A row whose
+    lookup raises, whether a :class:`GeocoderError` or a network error, is
+    reported in `failed` and keeps its stored result.
+    """
+    report = IncrementalReport()
+    now = clock()
+    pending = []
+    rows = list(rows)
+    for start in range(0, len(rows), _CHUNK):
+        chunk = rows[start:start + _CHUNK]
+        stored = store.digests(row_id for row_id, params in chunk)
+        for row_id, params in chunk:
+            digest = query_digest(params)
+            entry = stored.get(row_id)
+            if entry is None:
+                reason = 'new'
+            elif entry[0] != digest:
+                reason = 'changed'
+            elif max_age is not None and now - entry[1] >= max_age:
+                reason = 'expired'
+            else:
+                report.unchanged.append(row_id)
+                continue
+            pending.append((row_id, params, digest, reason))
+
+    limit = as_limit(concurrency)
+
+    def lookup(item):
+        return geocoder.geocode(limit=limit, **item[1]).raw
+
+    # store each chunk as soon as it is geocoded, so a crash or an
+    # interrupted run keeps the work already done
+    for start in range(0, len(pending), _CHUNK):
+        chunk = pending[start:start + _CHUNK]
+        # only fetches take a slot of the limit, cache hits run freely
+        outcomes = map_batch(lookup, chunk, limit, throttle=False)
+        for (row_id, params, digest, reason), outcome in zip(chunk, outcomes):
+            if isinstance(outcome, Exception):
+                report.failed[row_id] = outcome
+                continue
+            if reason != 'new':
+                _compare(report, store, row_id, reason, outcome, min_distance)
+            store.put(row_id, digest, outcome, now)
+            report.queried.append(row_id)
+            report.reasons[row_id] = reason
+        store.commit()
+    return report
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+"""
+Transports used by :meth:`pygeocoder.Geocoder.fetch_data` to send requests.
+
+* :class:`HTTPTransport` sends them to Google, and is the default.
+* :class:`RecordingTransport` wraps another transport and appends every
+  request/response pair to a file.
+* :class:`ReplayTransport` answers from recorded pairs without a network, with
+  optional latency, jitter and injected errors, for deterministic load tests.
+
+Example:
+
+    with RecordingTransport('geocode.jsonl') as recorder:
+        Geocoder(transport=recorder).geocode('paris')
+
+    replay = ReplayTransport('geocode.jsonl', latency=0.05, jitter=0.02,
+                             error_rates={'OVER_QUERY_LIMIT': 0.01, 503: 0.001,
+                                          TIMEOUT: 0.001}, seed=42)
+    Geocoder(transport=replay).geocode('paris')
+
+A transport is any object with a ``send(prepared, proxies=None)`` method
+taking a ``requests.PreparedRequest`` and returning an object with
+``status_code``, ``url``, ``elapsed`` and ``json()``.
+
+Recordings hold one JSON record per line and are indexed by request key when
+loaded. The key is the sorted query string without the credentials
+(``key``, ``client`` and ``signature``), so recordings made with one API key
+replay for any other.
+"""
+
+import datetime
+import random
+import threading
+import time
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__all__ = ['HTTPTransport', 'RecordingTransport', 'ReplayTransport',
+           'ReplayResponse', 'TIMEOUT', 'request_key']
+
+#: Key of :class:`ReplayTransport` error rates raising ``requests.Timeout``
+TIMEOUT = 'timeout'
+
+CREDENTIALS = ('key', 'client', 'signature')
+
+
+def request_key(request):
+    """
+    Return the replay key of a request.
+
+    :param request: Request URL, or dictionary of query parameters
+    :rtype: string
+    """
+    if isinstance(request, dict):
+        query = urlencode(request)
+    else:
+        query = request.partition('?')[2]
+    # compare the encoded pairs as they are, decoding them is needless work
+    return '&'.join(sorted(pair for pair in query.split('&')
+                           if pair and pair.partition('=')[0] not in CREDENTIALS))
+
+
+class HTTPTransport(object):
+    """
+    Sends each request with its own ``requests.Session``.
+    """
+
+    def send(self, prepared, proxies=None):
+        import requests
+
+        session = requests.Session()
+        if proxies:
+            session.proxies = proxies
+        try:
+            return session.send(prepared)
+        finally:
+            session.close()
+
+
+class ReplayResponse(object):
+    """
+    Minimal stand-in for ``requests.Response`` served by
+    :class:`ReplayTransport`.
+    """
+
+    def __init__(self, status_code, url, text, elapsed=0.0):
+        self.status_code = status_code
+        self.url = url
+        self.text = text
+        self.elapsed = datetime.timedelta(seconds=elapsed)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RecordingTransport(object):
+    """
+    Sends requests through `transport` and appends each request/response pair
+    to the file at `path`.
+    """
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport if transport is not None else HTTPTransport()
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def send(self, prepared, proxies=None):
+        response = self.transport.send(prepared, proxies)
+        record = {
+            'key': request_key(prepared.url),
+            'status_code': response.status_code,
+            'text': response.text,
+            'elapsed': response.elapsed.total_seconds(),
+        }
+        line = json.dumps(record, separators=(',', ':'), sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+        return response
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayTransport(object):
+    """
+    Serves recorded responses from memory.
+
+    Each request gets an injected error with the probability given in
+    `error_rates`, then waits `latency` plus up to `jitter` seconds before it
+    is answered. Error rate keys are a ``GeocoderError`` status such as
+    ``'OVER_QUERY_LIMIT'`` (an HTTP 200 response carrying that status), an
+    HTTP status code such as ``503``, or :data:`TIMEOUT`.
+
+    `calls`, `injected` and `misses` count what was served.
+    """
+
+    def __init__(self, path=None, latency=0.0, jitter=0.0, error_rates=None,
+                 seed=None, sleep=time.sleep):
+        """
+        :param path: Recording to load, see :class:`RecordingTransport`
+        :type path: string
+        :param latency: Seconds added to every response
+        :type latency: float
+        :param jitter: Up to this many more seconds, drawn uniformly
+        :type jitter: float
+        :param error_rates: Probability of each injected error
+        :type error_rates: dict
+        :param seed: Seed making latency and errors reproducible
+        :param sleep: Function used to wait
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rates = sorted((error_rates or {}).items(), key=lambda item: '%s' % (item[0],))
+        self.sleep = sleep
+        self.calls = 0
+        self.misses = 0
+        self.injected = {}
+        self._responses = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        if path is not None:
+            self.load(path)
+
+    def __len__(self):
+        return len(self._responses)
+
+    def load(self, path):
+        """
+        Index every record of the recording at `path`. Later records of the
+        same request replace earlier ones.
+        """
+        with open(path) as recording:
+            for line in recording:
+                if line.strip():
+                    record = json.loads(line)
+                    self._responses[record['key']] = (record['status_code'], record['text'])
+
+    def add(self, params, results=None, status='OK', status_code=200):
+        """
+        Add a response without recording it.
+
+        :param params: Query parameters the response answers
+        :type params: dict
+        :param results: Raw results list
+        :param status: Status of the response body
+        """
+        body = json.dumps({'status': status, 'results': results or []})
+        self._responses[request_key(params)] = (status_code, body)
+
+    def send(self, prepared, proxies=None):
+        with self._lock:
+            self.calls += 1
+            error = self._draw_error()
+            delay = self.latency
+            if self.jitter:
+                delay += self._random.uniform(0, self.jitter)
+            if error is not None:
+                self.injected[error] = self.injected.get(error, 0) + 1
+        if delay:
+            self.sleep(delay)
+
+        if error == TIMEOUT:
+            import requests
+            raise requests.Timeout("injected timeout for %s" % prepared.url)
+        if isinstance(error, int):
+            return ReplayResponse(error, prepared.url, '', delay)
+        if error is not None:
+            return ReplayResponse(200, prepared.url,
+                                  json.dumps({'status': error, 'results': []}), delay)
+
+        try:
+            status_code, text = self._responses[request_key(prepared.url)]
+        except KeyError:
+            with self._lock:
+                self.misses += 1
+            raise KeyError("no recorded response for %s" % prepared.url)
+        return ReplayResponse(status_code, prepared.url, text, delay)
+
+    def _draw_error(self):
+        # called with self._lock held
+        if not self.error_rates:
+            return None
+        draw = self._random.random()
+        for error, rate in self.error_rates:
+            if draw < rate:
+                return error
+            draw -= rate
+        return None
@@ -31,10 +31,11 @@ setup(
     download_url='http://code.xster.net/pygeocoder/downloads',
     description='Python interface for Google Geocoding API V3. Can be used to easily geocode, reverse geocode, validate and format addresses.',
     long_description=open(os.path.join(os.path.dirname(__file__), 'README.txt'), 'r').read(),
-    py_modules=['pygeocoder', 'pygeolib', '__version__'],
+    py_modules=['pygeocoder', 'pygeolib', 'pygeocache', 'pygeopack', 'pygeometry', 'pygeoprofile', 'pygeotransport', 'pygeobatch', 'pygeostore', '__version__'],
     provides=['pygeocoder'],
     requires=['json', 'functools', 'base64', 'hmac', 'hashlib'],
     install_requires=['requests >= 1.0'],
+    extras_require={'geometry': ['numpy']},
     classifiers=[
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
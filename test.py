@@ -14,12 +14,29 @@ Unit tests for pygeocoder.
 """
 
 import unittest
+import subprocess
+import sys
 import requests
 import json
+import mmap
+import pickle
+import tempfile
+import threading
+import time
 
 from collections import OrderedDict
 from pygeocoder import Geocoder
-from pygeolib import GeocoderResult, GeocoderError
+from pygeolib import GeocoderResult, GeocoderError, project
+from pygeocache import cache_key, ResultCache, MemoryBackend, RedisBackend, serve_backend
+import pygeopack
+from pygeoprofile import Profiler
+from pygeotransport import RecordingTransport, ReplayResponse, ReplayTransport, TIMEOUT
+from pygeobatch import AdaptiveLimit, run_batch
+from pygeostore import ResultStore, incremental_geocode
+try:
+    import pygeometry
+except ImportError:
+    pygeometry = None
 
 
 def searchkey(obj, key):
@@ -270,6 +287,26 @@ class Test(unittest.TestCase):
             else:
                 self.fail()
 
+    def test_projection(self):
+        """Test projecting results onto a few fields"""
+        data = json.loads(MOCK_DATA)
+        g = Geocoder()
+        g.fetch_data = lambda params: data
+        records = g.geocode('dmv', fields=('coordinates', 'postal_code', 'state__short_name', 'formatted_address'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1].coordinates, (38.86735470, -104.79270460))
+        self.assertEqual(records[1].postal_code, '80909')
+        self.assertEqual(records[1].state__short_name, 'CO')
+        self.assertEqual(records[0].formatted_address, 'DMV, 20725 Sherman Way, Winnetka, CA 91306, USA')
+
+        record = g.geocode('dmv', fields=('latitude', 'city'), first_only=True)
+        self.assertEqual(record, (34.20133510, 'Los Angeles'))
+        self.assertEqual(type(record), type(g.batch_geocode(['dmv'], fields=('latitude', 'city'))[0][0]))
+        self.assertEqual(g.geocode('dmv', first_only=True).count, 1)
+        self.assertRaises(ValueError, g.geocode, 'dmv', fields=('_private',))
+        self.assertEqual(pickle.loads(pickle.dumps(records)), records)
+        self.assertEqual(type(pickle.loads(pickle.dumps(record))), type(record))
+
     def test_geocode(self):
         """Test pygeocoder geocode()"""
 
@@ -344,6 +381,13 @@ class Test(unittest.TestCase):
         self.assertEqual(result.state, 'California')
         self.assertEqual(result.country, 'United States')
 
+    def test_lazy_import(self):
+        """Test importing pygeocoder does not load requests or requests_cache"""
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, pygeocoder; print(sorted(set(["requests", "requests_cache", "json"]) & set(sys.modules)))'])
+        self.assertEqual(loaded.strip(), b'[]')
+
     def test_business_auth(self):
         """Test Business API access.
 
@@ -375,5 +419,587 @@ class Test(unittest.TestCase):
         self.assertRegexpMatches(signed_request.url, r'&signature=7bVsUv6kyRHlG0DBAIhKHfX-96M=', 'Incorrect signature')
 
 
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CacheTest(unittest.TestCase):
+    """
+    Unit tests for the result cache. None of these hit the network.
+
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = []
+
+    def loader(self, value):
+        def load():
+            self.calls.append(value)
+            return value
+        return load
+
+    def test_fresh_and_expired(self):
+        """Test a plain TTL cache serves fresh entries and reloads expired ones"""
+        cache = ResultCache(soft_ttl=10, clock=self.clock)
+        self.assertEqual(cache.get('k', self.loader('a')), 'a')
+        self.assertEqual(cache.get('k', self.loader('b')), 'a')
+        self.clock.now += 10
+        self.assertEqual(cache.get('k', self.loader('c')), 'c')
+        self.assertEqual(self.calls, ['a', 'c'])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_stale_while_revalidate(self):
+        """Test stale entries are served immediately and refreshed once in the background"""
+        released = threading.Event()
+
+        def slow_load():
+            released.wait()
+            return self.loader('b')()
+
+        cache = ResultCache(soft_ttl=10, hard_ttl=100, clock=self.clock)
+        cache.get('k', self.loader('a'))
+        self.clock.now += 50
+        self.assertEqual(cache.get('k', slow_load), 'a')
+        self.assertEqual(cache.get('k', slow_load), 'a')
+        released.set()
+        cache.join()
+        self.assertEqual(cache.get('k', self.loader('c')), 'b')
+        self.assertEqual(self.calls, ['a', 'b'])
+        self.assertEqual(cache.refreshes, 1)
+
+    def test_failed_refresh_keeps_stale(self):
+        """Test a failing background refresh keeps serving the stale entry"""
+        def fail():
+            raise GeocoderError(GeocoderError.G_GEO_OVER_QUERY_LIMIT)
+
+        cache = ResultCache(soft_ttl=10, hard_ttl=100, clock=self.clock)
+        cache.get('k', self.loader('a'))
+        self.clock.now += 50
+        cache.get('k', fail)
+        cache.join()
+        self.assertEqual(cache.get('k', self.loader('b')), 'a')
+        self.assertEqual(cache.refresh_errors, 1)
+
+    def test_maxsize(self):
+        """Test least recently used entries are evicted"""
+        cache = ResultCache(soft_ttl=10, maxsize=2, clock=self.clock)
+        cache.get('a', self.loader(1))
+        cache.get('b', self.loader(2))
+        cache.get('a', self.loader(1))
+        cache.get('c', self.loader(3))
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_cache_key(self):
+        """Test separators inside values do not make two queries share a key"""
+        self.assertNotEqual(cache_key({'address': 'a&bounds=x', 'bounds': ''}),
+                            cache_key({'address': 'a', 'bounds': 'x&bounds='}))
+        self.assertEqual(cache_key({'a': '1', 'b': '2'}), cache_key({'b': '2', 'a': '1'}))
+
+    def test_concurrent_counters(self):
+        """Test counters stay exact when many threads share the cache"""
+        cache = ResultCache(soft_ttl=10, clock=self.clock)
+        cache.get('k', self.loader('a'))
+
+        def lookups():
+            for _ in range(1000):
+                cache.get('k', self.loader('b'))
+                cache.get('missing', lambda: None)
+
+        threads = [threading.Thread(target=lookups) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.hits + cache.misses, 16001)
+
+    def test_geocoder_uses_cache(self):
+        """Test Geocoder.geocode goes through the result cache"""
+        g = Geocoder(result_cache=ResultCache(soft_ttl=10, clock=self.clock))
+        g.fetch_data = lambda params: self.loader(json.loads(MOCK_DATA))()
+        self.assertEqual(g.geocode('dmv').postal_code, '91306')
+        self.assertEqual(g.geocode('dmv').postal_code, '91306')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_batch_geocode(self):
+        """Test batch_geocode keeps input order and returns errors in place"""
+        def fetch_data(params):
+            if params['address'] == 'nowhere':
+                raise GeocoderError(GeocoderError.G_GEO_ZERO_RESULTS)
+            return json.loads(MOCK_DATA)
+
+        g = Geocoder(result_cache=ResultCache(soft_ttl=10, backend=MemoryBackend()))
+        g.fetch_data = fetch_data
+        results = g.batch_geocode(['dmv', 'nowhere', 'dmv'])
+        self.assertEqual(results[0].city, 'Los Angeles')
+        self.assertEqual(results[1].status, GeocoderError.G_GEO_ZERO_RESULTS)
+        self.assertEqual(results[2].city, 'Los Angeles')
+        self.assertEqual(g.result_cache.hits, 1)
+
+    def test_shared_backend(self):
+        """Test results written by one cache are served to another through the L2 backend"""
+        backend = MemoryBackend(clock=self.clock)
+        data = json.loads(MOCK_DATA)
+        for key, serializer in (('json', None), ('packed', pygeopack)):
+            first = ResultCache(soft_ttl=10, clock=self.clock, backend=backend, serializer=serializer)
+            second = ResultCache(soft_ttl=10, clock=self.clock, backend=backend, serializer=serializer)
+            first.get(key, self.loader(data))
+            self.assertEqual(second.get(key, self.loader(None)), data)
+            self.assertEqual(second.remote_hits, 1)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_prefetch(self):
+        """Test prefetch warms process memory with a single multi-get"""
+        backend = MemoryBackend(clock=self.clock)
+        ResultCache(soft_ttl=10, clock=self.clock, backend=backend).get('a', self.loader([]))
+        cache = ResultCache(soft_ttl=10, clock=self.clock, backend=backend)
+        self.assertEqual(cache.prefetch(['a', 'b', 'a']), 1)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_redis_backend(self):
+        """Test the Redis protocol client against a locally served backend"""
+        server = serve_backend(MemoryBackend())
+        client = RedisBackend(*server.server_address)
+        try:
+            client.set_many({'a': b'1', 'b': b'\r\n2'}, ttl=60)
+            self.assertEqual(client.get_many(['a', 'missing', 'b']), [b'1', None, b'\r\n2'])
+            client.delete('a')
+            self.assertEqual(client.get('a'), None)
+
+            cache = ResultCache(soft_ttl=10, backend=client)
+            cache.get('k', self.loader(json.loads(MOCK_DATA)))
+            cache.clear()
+            self.assertEqual(cache.get('k', self.loader(None))[0]['types'],
+                             ['point_of_interest', 'establishment'])
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+
+    def test_unreachable_backend(self):
+        """Test an unreachable backend degrades to a local cache"""
+        server = serve_backend(MemoryBackend())
+        address = server.server_address
+        server.shutdown()
+        server.server_close()
+        cache = ResultCache(soft_ttl=10, backend=RedisBackend(*address))
+        data = json.loads(MOCK_DATA)
+        self.assertEqual(cache.get('k', self.loader(data)), data)
+        self.assertEqual(cache.get('k', self.loader(None)), data)
+        self.assertTrue(cache.backend_errors > 0)
+
+
+class PackTest(unittest.TestCase):
+    """
+    Unit tests for the binary result encoding.
+
+    """
+    def setUp(self):
+        self.data = json.loads(MOCK_DATA)
+
+    def test_round_trip(self):
+        """Test encoding is lossless, including keys and types it does not know"""
+        self.data[0]['place_id'] = 'ChIJ2eUgeAK6j4ARbn5u_wAGqWA'
+        self.data[0]['types'] = ['establishment', 'point_of_interest']
+        self.data[1]['address_components'][0]['types'].append('brand_new_type')
+        self.data[1]['geometry']['bounds'] = self.data[1]['geometry']['viewport']
+        self.data.append({'formatted_address': u'Z\xfcrich, Switzerland', 'partial_match': True})
+        packed = pygeopack.dumps(self.data)
+        self.assertEqual(pygeopack.loads(packed), self.data)
+        self.assertTrue(len(packed) < len(json.dumps(self.data, separators=(',', ':'))))
+
+    def test_mmap_reads(self):
+        """Test single fields are read straight from a memory-mapped buffer"""
+        with tempfile.TemporaryFile() as f:
+            f.write(pygeopack.dumps(self.data))
+            f.flush()
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            packed = pygeopack.PackedResults(buf)
+            self.assertEqual(len(packed), 2)
+            self.assertEqual(packed.coordinates(1), (38.86735470, -104.79270460))
+            self.assertEqual(packed.formatted_address(0), 'DMV, 20725 Sherman Way, Winnetka, CA 91306, USA')
+            self.assertEqual(packed[-1], self.data[1])
+            del packed
+            buf.close()
+
+    def test_pickle_result(self):
+        """Test GeocoderResult pickles and keeps its position"""
+        results = GeocoderResult(self.data)
+        next(results)
+        next(results)
+        copy = pickle.loads(pickle.dumps(results))
+        self.assertEqual(copy.raw, self.data)
+        self.assertEqual(copy.city, 'Colorado Springs')
+        self.assertRaises(StopIteration, next, copy)
+
+
+class TransportTest(unittest.TestCase):
+    """
+    Unit tests for the record and replay transports.
+
+    """
+    def setUp(self):
+        self.data = json.loads(MOCK_DATA)
+        self.replay = ReplayTransport()
+        self.replay.add({'address': 'dmv', 'sensor': 'false', 'bounds': '', 'region': '',
+                         'language': '', 'components': ''}, self.data)
+
+    def test_replay(self):
+        """Test replayed responses ignore credentials and unknown requests fail"""
+        g = Geocoder(api_key='any key', transport=self.replay)
+        self.assertEqual(g.geocode('dmv').raw, self.data)
+        self.assertRaises(KeyError, g.geocode, 'elsewhere')
+        self.assertEqual((self.replay.calls, self.replay.misses), (2, 1))
+
+    def test_record_and_replay(self):
+        """Test a recording replays the same results"""
+        with tempfile.NamedTemporaryFile(suffix='.jsonl') as f:
+            with RecordingTransport(f.name, transport=self.replay) as recorder:
+                Geocoder(transport=recorder).geocode('dmv')
+            replay = ReplayTransport(f.name)
+        self.assertEqual(len(replay), 1)
+        self.assertEqual(Geocoder(transport=replay).geocode('dmv').raw, self.data)
+
+    def test_injected_errors(self):
+        """Test injected query limits, server errors, timeouts and latency"""
+        delays = []
+        g = Geocoder(transport=self.replay)
+        self.replay.sleep = delays.append
+        self.replay.latency = 0.25
+        for error, status, status_code in (
+                (GeocoderError.G_GEO_OVER_QUERY_LIMIT, GeocoderError.G_GEO_OVER_QUERY_LIMIT, None),
+                (503, GeocoderError.G_HTTP_SERVER_ERROR, 503),
+                (429, GeocoderError.G_GEO_OVER_QUERY_LIMIT, 429),
+                (404, GeocoderError.G_HTTP_ERROR, 404)):
+            self.replay.error_rates = [(error, 1.0)]
+            try:
+                g.geocode('dmv')
+                self.fail()
+            except GeocoderError as err:
+                self.assertEqual((err.status, err.status_code), (status, status_code))
+        self.replay.error_rates = [(TIMEOUT, 1.0)]
+        self.assertRaises(requests.Timeout, g.geocode, 'dmv')
+        results = g.batch_geocode(['dmv', 'dmv'])
+        self.assertTrue(all(isinstance(err, requests.Timeout) for err in results))
+        self.assertEqual(delays, [0.25] * 7)
+
+    def test_seeded_error_rate(self):
+        """Test seeded error injection is reproducible and close to its rate"""
+        counts = []
+        for _ in range(2):
+            replay = ReplayTransport(error_rates={GeocoderError.G_GEO_OVER_QUERY_LIMIT: 0.1}, seed=7)
+            replay.add({'address': 'dmv'}, self.data)
+            request = requests.Request('GET', Geocoder.GEOCODE_QUERY_URL, params={'address': 'dmv'}).prepare()
+            for _ in range(2000):
+                replay.send(request)
+            counts.append(replay.injected)
+        self.assertEqual(counts[0], counts[1])
+        self.assertTrue(150 < counts[0][GeocoderError.G_GEO_OVER_QUERY_LIMIT] < 250)
+
+
+class BatchTest(unittest.TestCase):
+    """
+    Unit tests for concurrent batches and the adaptive concurrency limit.
+
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limit = AdaptiveLimit(initial=2, max_limit=8, clock=self.clock)
+
+    def saturate(self, latency, times):
+        for _ in range(times):
+            for _ in range(int(self.limit.limit)):
+                self.limit.acquire()
+            for _ in range(int(self.limit.limit)):
+                self.clock.now += latency
+                self.limit.release(latency)
+
+    def test_probe_up(self):
+        """Test the limit grows while latency is stable and the limit is used"""
+        self.saturate(0.1, 20)
+        self.assertEqual(self.limit.metrics()['limit'], 8)
+        self.assertEqual(self.limit.reason, 'probe')
+
+    def test_over_query_limit(self):
+        """Test OVER_QUERY_LIMIT halves the limit once per round trip"""
+        self.saturate(0.1, 20)
+        for _ in range(3):
+            self.limit.acquire()
+        for _ in range(3):
+            self.limit.release(0.1, GeocoderError.G_GEO_OVER_QUERY_LIMIT)
+        metrics = self.limit.metrics()
+        self.assertEqual(metrics['limit'], 4)
+        self.assertEqual(metrics['reason'], 'over_query_limit')
+        self.assertEqual(metrics['history'][-1], (self.clock.now, 4, 'over_query_limit'))
+
+    def test_latency(self):
+        """Test rising latency shrinks the limit"""
+        self.saturate(0.1, 20)
+        self.saturate(1.0, 3)
+        self.assertTrue(self.limit.limit < 8)
+        self.assertEqual(self.limit.reasons['latency'], self.limit.decreases)
+
+    def test_run_batch(self):
+        """Test results keep their order and OVER_QUERY_LIMIT is retried"""
+        attempts = {}
+
+        def func(item):
+            attempts[item] = attempts.get(item, 0) + 1
+            if item == 3 and attempts[item] == 1:
+                raise GeocoderError(GeocoderError.G_GEO_OVER_QUERY_LIMIT)
+            if item == 5:
+                raise GeocoderError(GeocoderError.G_GEO_ZERO_RESULTS)
+            return item * 10
+
+        delays = []
+        limit = AdaptiveLimit(initial=2, max_limit=4, sleep=delays.append)
+        results = run_batch(func, range(8), limit)
+        self.assertEqual(results[:5], [0, 10, 20, 30, 40])
+        self.assertEqual(results[5].status, GeocoderError.G_GEO_ZERO_RESULTS)
+        self.assertEqual(attempts[3], 2)
+        self.assertEqual(delays, [limit.retry_delay])
+
+    def test_latency_window(self):
+        """Test the lowest latency only covers the last `window` samples"""
+        limit = AdaptiveLimit(window=5, clock=self.clock)
+        for latency in [0.01] * 5 + [0.1] * 5:
+            limit.acquire()
+            limit.release(latency)
+        self.assertEqual(limit.min_latency, 0.1)
+
+    def test_cache_hits_skip_limit(self):
+        """Test results from the cache do not feed the limit"""
+        def fetch_data(params):
+            time.sleep(0.005)
+            return json.loads(MOCK_DATA)
+
+        g = Geocoder(result_cache=ResultCache(soft_ttl=60))
+        g.fetch_data = fetch_data
+        addresses = ['address %d' % i for i in range(40)]
+        g.batch_geocode(addresses[::2])
+        limit = AdaptiveLimit(initial=2, max_limit=8)
+        results = g.batch_geocode(addresses, concurrency=limit)
+        self.assertEqual(len(results), 40)
+        self.assertTrue(limit.min_latency >= 0.004)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_retry_keeps_query(self):
+        """Test a retried lookup keeps the API key out of its query and cache key"""
+        replay = ReplayTransport()
+        replay.add({'address': 'a', 'sensor': 'false', 'bounds': '', 'region': '',
+                    'language': '', 'components': ''}, json.loads(MOCK_DATA))
+        sent = []
+
+        class LimitedOnce(object):
+            def send(self, prepared, proxies=None):
+                sent.append(prepared.url)
+                if len(sent) == 1:
+                    return ReplayResponse(200, prepared.url, json.dumps({'status': 'OVER_QUERY_LIMIT'}))
+                return replay.send(prepared, proxies)
+
+        g = Geocoder(api_key='SECRET', result_cache=ResultCache(soft_ttl=60), transport=LimitedOnce())
+        limit = AdaptiveLimit(sleep=lambda seconds: None)
+        self.assertEqual(g.batch_geocode(['a'], concurrency=limit)[0].raw, json.loads(MOCK_DATA))
+        self.assertEqual(g.geocode('a').raw, json.loads(MOCK_DATA))
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(g.result_cache.hits, 1)
+        self.assertTrue(all(url.count('key=SECRET') == 1 for url in sent))
+
+    def test_concurrent_batch_geocode(self):
+        """Test batch_geocode against a replayed server injecting query limits"""
+        replay = ReplayTransport(error_rates={GeocoderError.G_GEO_OVER_QUERY_LIMIT: 0.2}, seed=3)
+        addresses = ['address %d' % i for i in range(50)]
+        for address in addresses:
+            replay.add({'address': address, 'sensor': 'false', 'bounds': '', 'region': '',
+                        'language': '', 'components': ''}, json.loads(MOCK_DATA))
+        limit = AdaptiveLimit(initial=4, max_limit=8, sleep=lambda seconds: None)
+        results = Geocoder(transport=replay).batch_geocode(
+            addresses, fields=('postal_code',), first_only=True, concurrency=limit)
+        self.assertEqual(len(results), 50)
+        failed = [result for result in results if isinstance(result, GeocoderError)]
+        self.assertEqual(len(results) - len(failed), results.count(('91306',)))
+        self.assertTrue(limit.metrics()['reasons'].get('over_query_limit'))
+        self.assertEqual(limit.in_flight, 0)
+
+
+class IncrementalTest(unittest.TestCase):
+    """
+    Unit tests for incremental re-geocoding.
+
+    """
+    def setUp(self):
+        self.clock = FakeClock()
+        self.data = json.loads(MOCK_DATA)
+        self.replay = ReplayTransport()
+        for address, data in (('dmv', self.data), ('colorado dmv', self.data[1:]),
+                              ('winnetka dmv', self.data[:1])):
+            self.replay.add({'address': address, 'sensor': 'false', 'bounds': '', 'region': '',
+                             'language': '', 'components': ''}, data)
+        self.replay.add({'address': 'nowhere', 'sensor': 'false', 'bounds': '', 'region': '',
+                         'language': '', 'components': ''}, status=GeocoderError.G_GEO_ZERO_RESULTS)
+        self.geocoder = Geocoder(transport=self.replay)
+        self.store = ResultStore()
+
+    def run_rows(self, addresses, **kwargs):
+        rows = [(row_id, {'address': address}) for row_id, address in enumerate(addresses)]
+        return incremental_geocode(self.geocoder, rows, self.store, clock=self.clock, **kwargs)
+
+    def test_skip_unchanged(self):
+        """Test only new, changed and expired rows are queried"""
+        report = self.run_rows(['dmv', 'colorado dmv'])
+        self.assertEqual(report.queried, [0, 1])
+        self.assertEqual(report.reasons, {0: 'new', 1: 'new'})
+        self.assertEqual(report.changes, [])
+
+        report = self.run_rows(['dmv', 'colorado dmv'])
+        self.assertEqual((report.unchanged, report.queried), ([0, 1], []))
+        self.assertEqual(self.replay.calls, 2)
+
+        self.clock.now += 100
+        report = self.run_rows(['dmv', 'colorado dmv'], max_age=50)
+        self.assertEqual(report.reasons, {0: 'expired', 1: 'expired'})
+        self.assertEqual(report.changes, [])
+
+    def test_changes(self):
+        """Test moved results are reported and failures keep the stored result"""
+        self.run_rows(['dmv', 'colorado dmv'])
+        report = self.run_rows(['winnetka dmv', 'nowhere'])
+        self.assertEqual(report.reasons, {0: 'changed'})
+        self.assertEqual(list(report.failed), [1])
+        self.assertEqual(report.changes, [])
+        self.assertEqual(self.store.get(1), self.data[1:])
+
+        report = self.run_rows(['colorado dmv', 'dmv'], concurrency=2)
+        self.assertEqual(len(report.changes), 2)
+        change = report.changes[0]
+        self.assertEqual(change.row_id, 0)
+        self.assertEqual(change.new_address, self.data[1]['formatted_address'])
+        self.assertAlmostEqual(change.distance / 1000, 1335, 0)
+        self.assertEqual(len(self.store), 2)
+
+    def test_cache_hits_skip_limit(self):
+        """Test rows answered by the result cache do not feed the limit"""
+        def fetch_data(params):
+            time.sleep(0.005)
+            return self.data
+
+        g = Geocoder(result_cache=ResultCache(soft_ttl=60))
+        g.fetch_data = fetch_data
+        addresses = ['address %d' % i for i in range(40)]
+        for address in addresses[::2]:
+            g.geocode(address)
+        limit = AdaptiveLimit(initial=2, max_limit=8)
+        report = incremental_geocode(g, enumerate({'address': address} for address in addresses),
+                                     self.store, concurrency=limit)
+        self.assertEqual(len(report.queried), 40)
+        self.assertTrue(limit.min_latency >= 0.004)
+
+    def test_network_errors(self):
+        """Test other errors fail their row and keep the results of the others"""
+        with tempfile.NamedTemporaryFile(suffix='.db') as f:
+            self.store = ResultStore(f.name)
+            report = self.run_rows(['dmv', 'colorado dmv', 'winnetka dmv', 'unrecorded'])
+            self.assertEqual(report.queried, [0, 1, 2])
+            self.assertTrue(isinstance(report.failed[3], KeyError))
+            self.assertEqual(len(ResultStore(f.name)), 3)
+
+
+class ProfileTest(unittest.TestCase):
+    """
+    Unit tests for the profiling mode.
+
+    """
+    def test_phases(self):
+        """Test nested phases, percentiles and the folded trace"""
+        clock = FakeClock()
+        profiler = Profiler(timer=clock)
+        for duration in (1, 2, 3, 4):
+            with profiler.phase('geocode'):
+                with profiler.phase('send'):
+                    clock.now += duration
+                    profiler.record('server', duration / 2.0)
+                clock.now += 1
+        self.assertEqual(profiler.percentiles('geocode;send', (0, 50, 100)),
+                         {0: 1, 50: 2.5, 100: 4})
+        self.assertEqual(profiler.folded(), 'geocode 4000000\ngeocode;send 5000000\ngeocode;send;server 5000000\n')
+        report = profiler.report().splitlines()
+        self.assertEqual([line.split()[:2] for line in report[1:]],
+                         [['geocode', '4'], ['send', '4'], ['server', '4']])
+
+    def test_bounded_samples(self):
+        """Test only `reservoir` durations are kept per phase"""
+        profiler = Profiler(reservoir=10, seed=1)
+        for duration in range(1000):
+            profiler.record('send', float(duration))
+        stats = profiler.phases[('send',)]
+        self.assertEqual((stats.count, stats.total, len(stats.samples)), (1000, 499500.0, 10))
+        self.assertTrue(200 < profiler.percentiles('send', (50,))[50] < 800)
+
+    def test_geocoder_profile(self):
+        """Test Geocoder records the phases of its calls"""
+        g = Geocoder(profile=True, result_cache=ResultCache(soft_ttl=10))
+        g.fetch_data = lambda params: json.loads(MOCK_DATA)
+        g.geocode('dmv')
+        g.geocode('dmv')
+        self.assertEqual(sorted(g.profiler.phases), [('geocode',), ('geocode', 'result')])
+        self.assertEqual(g.profiler.phases[('geocode',)].count, 2)
+        self.assertEqual(Geocoder().profiler, None)
+
+
+@unittest.skipIf(pygeometry is None, "pygeometry requires numpy")
+class GeometryTest(unittest.TestCase):
+    """
+    Unit tests for the vectorized geometry helpers.
+
+    """
+    def setUp(self):
+        self.results = GeocoderResult(json.loads(MOCK_DATA))
+        self.points = pygeometry.coordinates([self.results])
+
+    def test_coordinates(self):
+        """Test coordinates are collected from GeocoderResult objects"""
+        self.assertEqual(self.points.shape, (2, 2))
+        self.assertAlmostEqual(self.points[1, 0], 38.86735470)
+
+    def test_coordinates_of_batch(self):
+        """Test failed lookups are skipped and projected records are accepted"""
+        records = project(self.results.raw, ('coordinates',))
+        points = pygeometry.coordinates([records, GeocoderError('ZERO_RESULTS'), records[0]])
+        self.assertEqual(points.shape, (3, 2))
+        self.assertAlmostEqual(points[2, 1], self.points[0, 1])
+        self.assertRaises(ValueError, pygeometry.coordinates,
+                          [project(self.results.raw, ('postal_code',))])
+
+    def test_haversine(self):
+        """Test one-to-many and pairwise distances agree"""
+        depot = (34.0522, -118.2437)
+        to_depot = pygeometry.haversine_to(self.points, depot)
+        matrix = pygeometry.haversine_matrix(self.points, [depot])
+        self.assertAlmostEqual(to_depot[0] / 1000, 36.0, 0)
+        self.assertTrue((abs(matrix[:, 0] - to_depot) < 1e-6).all())
+        square = pygeometry.haversine_matrix(self.points)
+        self.assertEqual(square[0, 0], 0)
+        self.assertAlmostEqual(pygeometry.haversine(self.points, self.points[::-1])[0], square[0, 1])
+
+    def test_bounds(self):
+        """Test bounding boxes, viewport unions and the bounds parameter string"""
+        self.assertEqual(pygeometry.bounding_box(self.points),
+                         (34.2013351, -118.5847993, 38.8673547, -104.7927046))
+        box = pygeometry.viewport_union([self.results])
+        self.assertEqual(box, (34.1921062, -118.6008067, 38.8687036802915, -104.7913556197085))
+        self.assertEqual(pygeometry.bounds_string(box), '34.192106,-118.600807|38.868704,-104.791356')
+
+    def test_cluster(self):
+        """Test near-duplicate points share a cluster label"""
+        points = [(34.2013351, -118.5847993), (38.8673547, -104.7927046),
+                  (34.2013360, -118.5847980), (34.2100000, -118.5847993)]
+        self.assertEqual(list(pygeometry.cluster(points, cell_size=50)), [0, 1, 0, 2])
+
+
 if __name__ == "__main__":
     unittest.main()